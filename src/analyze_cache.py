@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Union
+from azure.ai.documentintelligence.models import AnalyzeResult
+
+
+class AnalyzeResultCache:
+    """ Persistent cache for Document Intelligence analysis results.
+    Entries are keyed by the PDF content hash, the analyzed page set and
+    the model id, stored as serialized AnalyzeResult JSON, and evicted by
+    age (TTL) and by total size (least recently used first).
+    """
+
+    def __init__(self, db_path: str, ttl_seconds: int = 7 * 24 * 3600, max_bytes: int = 500 * 1024 * 1024):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS analyze_results (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(document_bytes: bytes, pages: list[int], model_id: str) -> str:
+        """ Build the cache key for an analysis request.
+        Args:
+            document_bytes (bytes): The full document content in bytes.
+            pages (list[int]): The page numbers analyzed.
+            model_id (str): The Document Intelligence model id.
+        Returns:
+            str: The hex digest identifying the analysis request.
+        """
+
+        document_hash = hashlib.sha256(document_bytes).hexdigest()
+        page_set = ",".join(map(str, sorted(set(pages))))
+        return hashlib.sha256(f"{document_hash}|{page_set}|{model_id}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Union[AnalyzeResult, None]:
+        """ Return the cached analysis result for a key, or None.
+        Args:
+            key (str): The cache key from make_key.
+        Returns:
+            Union[AnalyzeResult, None]: The rehydrated result, or None on a miss or expired entry.
+        """
+
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result, created FROM analyze_results WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM analyze_results WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE analyze_results SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return AnalyzeResult(json.loads(row[0]))
+
+    def put(self, key: str, result: AnalyzeResult) -> None:
+        """ Store an analysis result, then drop expired entries and the least
+        recently used ones beyond the size limit.
+        Args:
+            key (str): The cache key from make_key.
+            result (AnalyzeResult): The analysis result to store.
+        """
+
+        payload = json.dumps(result.as_dict())
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analyze_results VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now))
+            self._conn.execute(
+                "DELETE FROM analyze_results WHERE created < ?", (now - self.ttl_seconds,))
+            rows = self._conn.execute(
+                "SELECT key, size FROM analyze_results ORDER BY last_access DESC").fetchall()
+            total, evicted = 0, []
+            for row_key, size in rows:
+                total += size
+                if total > self.max_bytes and row_key != key:
+                    evicted.append((row_key,))
+            self._conn.executemany("DELETE FROM analyze_results WHERE key = ?", evicted)
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        """ Return hit/miss counters, entry count and stored bytes.
+        Returns:
+            dict: A dictionary with hits, misses, entries and bytes.
+        """
+
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyze_results").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
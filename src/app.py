@@ -1,10 +1,17 @@
 import streamlit as st
 import os
+import time
+import asyncio
 import pandas as pd
-from utils import load_invoices
+from typing import Union
+from utils import get_pdf_page_count, render_page_image
+from folder_index import FolderIndex, DEFAULT_FOLDER_INDEX_PATH
 from foundry_service import FoundryService
 from doc_intel_service import DocumentIntelligenceService
-from azure.ai.documentintelligence.models import AnalyzeResult
+from invoice_model import Address
+from invoice_export import InvoiceExporter
+from pipeline import classify_and_extract
+from metrics import metrics, StageTimings
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -13,6 +20,11 @@ load_dotenv(override=True)
 # Initialize services
 foundry_service = FoundryService()
 document_intelligence_service = DocumentIntelligenceService()
+# Parquet export of the extracted invoices, disabled when INVOICE_EXPORT_PATH is empty
+invoice_exporter = InvoiceExporter(os.getenv("INVOICE_EXPORT_PATH")) if os.getenv("INVOICE_EXPORT_PATH") else None
+# Index of the documents folder, so loading only reads new or changed files
+folder_index = FolderIndex(os.getenv("FOLDER_INDEX_PATH", DEFAULT_FOLDER_INDEX_PATH) or None)
+INVOICE_TABLE_PAGE_SIZE = int(os.getenv("INVOICE_TABLE_PAGE_SIZE", "100"))
 
 # Get document paths for documents
 workspace_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -21,318 +33,280 @@ docs_folder = os.path.join(workspace_root, "documents")
 
 # Load invoice records from local folder
 def load_invoice_records() -> None:
-    invoice_records = load_invoices(docs_folder)
-    df = pd.DataFrame(invoice_records)
-    st.session_state["invoice_df"] = df
+    st.session_state["invoice_scan"] = folder_index.scan(docs_folder)
 
 
-# Show preprocessing results
-def show_preprocessing_results(pages: list) -> None:
-    """ Display preprocessing results in a table with images.
+# Page gallery settings: thumbnails per gallery page and per row
+GALLERY_PAGE_SIZE = int(os.getenv("GALLERY_PAGE_SIZE", "12"))
+GALLERY_COLUMNS = 4
+
+
+@st.cache_data(max_entries=int(os.getenv("THUMBNAIL_CACHE_ENTRIES", "1000")), show_spinner=False)
+def get_page_thumbnail(pdf_path: str, page_num: int, version: int) -> bytes:
+    """ Render a small thumbnail of a page, cached across reruns and sessions.
+    Args:
+        pdf_path (str): The path to the PDF file.
+        page_num (int): The 1-based page number.
+        version (int): The file modification time, so changed files are rendered again.
+    Returns:
+        bytes: The thumbnail image.
+    """
+
+    return render_page_image(pdf_path, page_num, "thumbnail")["bytes"]
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def get_page_image(pdf_path: str, page_num: int, version: int) -> bytes:
+    """ Render a page at full resolution. Only a few are cached, as they are only rendered on request. """
+
+    return render_page_image(pdf_path, page_num, "display")["bytes"]
+
+
+def page_table_row(page: dict) -> dict:
+    """ Summarize the classification of a page as a row of the pages table. """
+
+    input_tokens, output_tokens = int(page["input_tokens"] or 0), int(page["output_tokens"] or 0)
+    return {
+        "Page": page["page_num"],
+        "Is Invoice": "Yes" if page["is_invoice"] else "No",
+        "Payload (KB)": round(page.get("payload_bytes", 0) / 1024, 1),
+        "Input Tokens": input_tokens,
+        "Output Tokens": output_tokens,
+        "Total Tokens": input_tokens + output_tokens,
+        "Decided By": page.get("decided_by", "llm"),
+        "Duplicate Of": describe_duplicate(page.get("duplicate_of")),
+    }
+
+
+def gallery_slots(page_nums: list) -> dict:
+    """ Lay out a grid of placeholders, one per page.
     Args:
-        pages (list): The list of pages with preprocessing results.
+        page_nums (list): The page numbers to show.
+    Returns:
+        dict: Page number mapped to its placeholder.
+    """
+
+    slots = {}
+    for row_start in range(0, len(page_nums), GALLERY_COLUMNS):
+        columns = st.columns(GALLERY_COLUMNS)
+        for column, page_num in zip(columns, page_nums[row_start:row_start + GALLERY_COLUMNS]):
+            slots[page_num] = column.empty()
+    return slots
+
+
+# Show a page of the gallery
+def show_page_tile(pdf_path: str, version: int, page_num: int, page: Union[dict, None]) -> None:
+    """ Display the thumbnail of a page with its classification result, if known yet.
+    Args:
+        pdf_path (str): The path to the PDF file.
+        version (int): The file modification time.
+        page_num (int): The 1-based page number.
+        page (dict): The page with its preprocessing result, or None while it is classified.
     Returns:
         None
     """
 
-    # Create table data
-    table_data = []
-    for page in pages:
-        table_data.append({
-            "Page": page["page_num"],
-            "Is Invoice": "Yes" if page["is_invoice"] else "No",
-            "Image": page["image"],
-            "Input Tokens": page["input_tokens"],
-            "Output Tokens": page["output_tokens"],
-            "Total Tokens": int(page["input_tokens"]) + int(page["output_tokens"]),
-        })
-
-    # Create DataFrame
-    df_images = pd.DataFrame(table_data)
-
-    # Display table with images
-    st.subheader("Document Pages")
+    st.image(get_page_thumbnail(pdf_path, page_num, version), width=200)
+    st.write(f"**Page {page_num}**")
+    if page is None:
+        st.caption("Classifying...")
+        return
+    # Color the Is Invoice line based on value
+    if page["is_invoice"]:
+        st.markdown("Is Invoice: <span style='color: green;'>Yes</span>", unsafe_allow_html=True)
+    else:
+        st.markdown("Is Invoice: <span style='color: red;'>No</span>", unsafe_allow_html=True)
+    st.caption(f"Decided by: {page.get('decided_by', 'llm')}")
+    if page.get("duplicate_of"):
+        st.caption(f"♻️ Duplicate of {describe_duplicate(page['duplicate_of'])}")
+
+
+def show_document_pages(pdf_path: str, pages: list) -> None:
+    """ Display the classified pages as a table and a paginated thumbnail gallery.
+    Only the thumbnails of the current gallery page are sent to the browser,
+    and a full resolution image is only rendered for the page selected.
+    Args:
+        pdf_path (str): The path to the PDF file.
+        pages (list): The pages with their preprocessing results.
+    Returns:
+        None
+    """
 
-    # Use custom rendering to display images
-    for idx, row in df_images.iterrows():
-        col1, col2 = st.columns([3, 6])
-        with col1:
-            st.write(f"**Page {row['Page']}**")
-            # Color the Is Invoice line based on value
-            if row['Is Invoice'] == "Yes":
-                st.markdown(
-                    f"Is Invoice: <span style='color: green;'>{row['Is Invoice']}</span>", unsafe_allow_html=True)
-            else:
-                st.markdown(
-                    f"Is Invoice: <span style='color: red;'>{row['Is Invoice']}</span>", unsafe_allow_html=True)
-            st.write(f"Input Tokens: {row['Input Tokens']}")
-            st.write(f"Output Tokens: {row['Output Tokens']}")
-            st.write(f"Total Tokens: {row['Total Tokens']}")
-        with col2:
-            st.image(
-                f"data:image/png;base64,{row['Image']}", width=200)
-
-
-def extract_content_from_invoices(file_name: str, pages: list) -> None:
-    """ Extract and display content from the invoices.
+    st.subheader("Document Pages")
+    st.dataframe(pd.DataFrame([page_table_row(page) for page in pages]), hide_index=True)
+
+    version = os.stat(pdf_path).st_mtime_ns
+    pages_by_num = {page["page_num"]: page for page in pages}
+    page_nums = sorted(pages_by_num)
+    gallery_pages = max(1, -(-len(page_nums) // GALLERY_PAGE_SIZE))
+    gallery_page = 1
+    if gallery_pages > 1:
+        gallery_page = st.number_input(
+            f"Gallery page (of {gallery_pages})", min_value=1, max_value=gallery_pages, key="gallery_page")
+    start = (gallery_page - 1) * GALLERY_PAGE_SIZE
+    for page_num, slot in gallery_slots(page_nums[start:start + GALLERY_PAGE_SIZE]).items():
+        with slot.container():
+            show_page_tile(pdf_path, version, page_num, pages_by_num[page_num])
+
+    selected = st.selectbox("Show page at full resolution", [None] + page_nums, key="full_page",
+                            format_func=lambda page_num: "None" if page_num is None else f"Page {page_num}")
+    if selected:
+        st.image(get_page_image(pdf_path, selected, version))
+
+
+def show_page_invoices(page: dict, invoices: list) -> None:
+    """ Display the invoices extracted from an invoice page.
     Args:
-        file_name (str): The name of the selected invoice file.
-        pages (list): The list of pages with preprocessing results.
+        page (dict): The page classified as an invoice.
+        invoices (list): The normalized invoices extracted from it.
     Returns:
         None
     """
 
-    # Extract content from invoices
-    invoice_pages = [page for page in pages if page["is_invoice"]]
-    for page in invoice_pages:
-        st.subheader(f"Extracting Content from Page {page['page_num']}...")
-        # Call Document Intelligence Service to extract content
-        pdf_path = os.path.join(docs_folder, file_name)
+    st.subheader(f"Content of Page {page['page_num']}")
+    if page.get("duplicate_of"):
+        st.caption(f"♻️ Duplicate of {describe_duplicate(page['duplicate_of'])}")
+
+    # Display extracted content
+    if invoices:
+        for idx, invoice in enumerate(invoices):
+            st.markdown(f"### 📄 Invoice #{idx + 1}")
+
+            # Create 2x2 grid layout with equal height and width
+            # First row
+            col1, col2 = st.columns(2)
+
+            with col1:
+                with st.container(border=True):
+                    st.markdown("#### 🏢 Vendor Information")
+                    show_value("Vendor Name", invoice.vendor_name)
+                    show_address("Address", "Address Recipient", invoice.vendor_address)
+
+            with col2:
+                with st.container(border=True):
+                    st.markdown("#### 👤 Customer Information")
+                    show_value("Customer Name", invoice.customer_name)
+                    show_value("Customer ID", invoice.customer_id)
+                    show_address("Address", "Address Recipient", invoice.customer_address)
+
+            # Second row
+            col3, col4 = st.columns(2)
+
+            with col3:
+                with st.container(border=True):
+                    st.markdown("#### 📍 Billing & Shipping")
+                    show_address("Billing Address", "Billing Recipient", invoice.billing_address)
+                    show_address("Shipping Address", "Shipping Recipient", invoice.shipping_address)
+
+            with col4:
+                with st.container(border=True):
+                    st.markdown("#### 📋 Invoice Details")
+                    show_value("Invoice ID", invoice.invoice_id)
+                    show_value("Invoice Date", invoice.invoice_date)
+                    show_value("Due Date", invoice.due_date)
+                    show_value("Purchase Order", invoice.purchase_order)
+                    if invoice.invoice_total:
+                        st.markdown(
+                            f"**💰 Invoice Total:** `{invoice.invoice_total.content}`")
 
-        # Read PDF file as bytes
-        with open(pdf_path, "rb") as f:
-            document_bytes = f.read()
+            st.divider()
+            st.markdown("#### 🛒 Invoice Items")
+
+            # Create items table
+            items_data = []
+            for idx, item in enumerate(invoice.items):
+                item_dict = {"Item #": idx + 1}
+                if item.description:
+                    item_dict["Description"] = item.description
+                if item.quantity is not None:
+                    item_dict["Quantity"] = item.quantity
+                if item.unit:
+                    item_dict["Unit"] = item.unit
+                if item.unit_price:
+                    item_dict["Unit Price"] = f"{item.unit_price.content}{item.unit_price.currency or ''}"
+                if item.product_code:
+                    item_dict["Product Code"] = item.product_code
+                if item.date:
+                    item_dict["Date"] = item.date
+                if item.tax:
+                    item_dict["Tax"] = item.tax.content
+                if item.amount:
+                    item_dict["Amount"] = item.amount.content
+                items_data.append(item_dict)
+
+            # Display items as dataframe
+            if items_data:
+                items_df = pd.DataFrame(items_data)
+                st.dataframe(items_df)
+
+            st.divider()
 
-        # Analyze document for the specific page
-        invoices: AnalyzeResult = document_intelligence_service.analyze_document(
-            document_bytes, pages=[page["page_num"]])
+            # Financial Summary
+            st.markdown("#### 💵 Financial Summary")
+            col1, col2, col3 = st.columns(3)
 
-        # Display extracted content
-        if invoices.documents:
-            for idx, invoice in enumerate(invoices.documents):
-                st.markdown(f"### 📄 Invoice #{idx + 1}")
+            with col1:
+                if invoice.sub_total:
+                    st.metric("Subtotal", invoice.sub_total.content)
+                if invoice.total_tax:
+                    st.metric("Total Tax", invoice.total_tax.content)
 
-                # Create 2x2 grid layout with equal height and width
-                # First row
+            with col2:
+                if invoice.previous_unpaid_balance:
+                    st.metric("Previous Unpaid Balance", invoice.previous_unpaid_balance.content)
+                if invoice.amount_due:
+                    st.metric("Amount Due", invoice.amount_due.content)
+
+            with col3:
+                show_value("Service Start", invoice.service_start_date)
+                show_value("Service End", invoice.service_end_date)
+
+            # Additional Addresses
+            if invoice.service_address or invoice.remittance_address:
+                st.divider()
+                st.markdown("#### 📮 Additional Addresses")
                 col1, col2 = st.columns(2)
 
                 with col1:
-                    with st.container(border=True):
-                        st.markdown("#### 🏢 Vendor Information")
-                        vendor_name = invoice.fields.get("VendorName")
-                        if vendor_name:
-                            st.markdown(
-                                f"**Vendor Name:** {vendor_name.get('content')}")
-
-                        vendor_address = invoice.fields.get("VendorAddress")
-                        if vendor_address:
-                            st.markdown(
-                                f"**Address:** {vendor_address.get('content')}")
-
-                        vendor_address_recipient = invoice.fields.get(
-                            "VendorAddressRecipient")
-                        if vendor_address_recipient:
-                            st.markdown(
-                                f"**Address Recipient:** {vendor_address_recipient.get('content')}")
+                    show_address("Service Address", "Service Recipient", invoice.service_address)
 
                 with col2:
-                    with st.container(border=True):
-                        st.markdown("#### 👤 Customer Information")
-                        customer_name = invoice.fields.get("CustomerName")
-                        if customer_name:
-                            st.markdown(
-                                f"**Customer Name:** {customer_name.get('content')}")
-
-                        customer_id = invoice.fields.get("CustomerId")
-                        if customer_id:
-                            st.markdown(
-                                f"**Customer ID:** {customer_id.get('content')}")
-
-                        customer_address = invoice.fields.get(
-                            "CustomerAddress")
-                        if customer_address:
-                            st.markdown(
-                                f"**Address:** {customer_address.get('content')}")
-
-                        customer_address_recipient = invoice.fields.get(
-                            "CustomerAddressRecipient")
-                        if customer_address_recipient:
-                            st.markdown(
-                                f"**Address Recipient:** {customer_address_recipient.get('content')}")
-
-                # Second row
-                col3, col4 = st.columns(2)
-
-                with col3:
-                    with st.container(border=True):
-                        st.markdown("#### 📍 Billing & Shipping")
-                        billing_address = invoice.fields.get("BillingAddress")
-                        if billing_address:
-                            st.markdown(
-                                f"**Billing Address:** {billing_address.get('content')}")
-
-                        billing_address_recipient = invoice.fields.get(
-                            "BillingAddressRecipient")
-                        if billing_address_recipient:
-                            st.markdown(
-                                f"**Billing Recipient:** {billing_address_recipient.get('content')}")
-
-                        shipping_address = invoice.fields.get(
-                            "ShippingAddress")
-                        if shipping_address:
-                            st.markdown(
-                                f"**Shipping Address:** {shipping_address.get('content')}")
-
-                        shipping_address_recipient = invoice.fields.get(
-                            "ShippingAddressRecipient")
-                        if shipping_address_recipient:
-                            st.markdown(
-                                f"**Shipping Recipient:** {shipping_address_recipient.get('content')}")
-
-                with col4:
-                    with st.container(border=True):
-                        st.markdown("#### 📋 Invoice Details")
-                        invoice_id = invoice.fields.get("InvoiceId")
-                        if invoice_id:
-                            st.markdown(
-                                f"**Invoice ID:** {invoice_id.get('content')}")
-
-                        invoice_date = invoice.fields.get("InvoiceDate")
-                        if invoice_date:
-                            st.markdown(
-                                f"**Invoice Date:** {invoice_date.get('content')}")
-
-                        due_date = invoice.fields.get("DueDate")
-                        if due_date:
-                            st.markdown(
-                                f"**Due Date:** {due_date.get('content')}")
-
-                        purchase_order = invoice.fields.get("PurchaseOrder")
-                        if purchase_order:
-                            st.markdown(
-                                f"**Purchase Order:** {purchase_order.get('content')}")
-
-                        invoice_total = invoice.fields.get("InvoiceTotal")
-                        if invoice_total:
-                            st.markdown(
-                                f"**💰 Invoice Total:** `{invoice_total.get('content')}`")
+                    show_address("Remittance Address", "Remittance Recipient", invoice.remittance_address)
 
-                st.divider()
-                st.markdown("#### 🛒 Invoice Items")
-
-                # Create items table
-                items_data = []
-                for idx, item in enumerate(invoice.fields.get("Items").get("valueArray")):
-                    item_dict = {"Item #": idx + 1}
-
-                    item_description = item.get(
-                        "valueObject").get("Description")
-                    if item_description:
-                        item_dict["Description"] = item_description.get(
-                            'content')
-
-                    item_quantity = item.get("valueObject").get("Quantity")
-                    if item_quantity:
-                        item_dict["Quantity"] = item_quantity.get('content')
-
-                    unit = item.get("valueObject").get("Unit")
-                    if unit:
-                        item_dict["Unit"] = unit.get('content')
-
-                    unit_price = item.get("valueObject").get("UnitPrice")
-                    if unit_price:
-                        unit_price_code = (
-                            unit_price.get("valueCurrency").get("currencyCode")
-                            if unit_price.get("valueCurrency").get("currencyCode")
-                            else ""
-                        )
-                        item_dict["Unit Price"] = f"{unit_price.get('content')}{unit_price_code}"
-
-                    product_code = item.get("valueObject").get("ProductCode")
-                    if product_code:
-                        item_dict["Product Code"] = product_code.get('content')
-
-                    item_date = item.get("valueObject").get("Date")
-                    if item_date:
-                        item_dict["Date"] = item_date.get('content')
-
-                    tax = item.get("valueObject").get("Tax")
-                    if tax:
-                        item_dict["Tax"] = tax.get('content')
-
-                    amount = item.get("valueObject").get("Amount")
-                    if amount:
-                        item_dict["Amount"] = amount.get('content')
-
-                    items_data.append(item_dict)
-
-                # Display items as dataframe
-                if items_data:
-                    items_df = pd.DataFrame(items_data)
-                    st.dataframe(items_df)
+        st.divider()
 
-                st.divider()
 
-                # Financial Summary
-                st.markdown("#### 💵 Financial Summary")
-                col1, col2, col3 = st.columns(3)
+def describe_duplicate(duplicate_of: Union[dict, None]) -> str:
+    """ Describe the page a duplicate page copies, or return "" for original pages. """
 
-                with col1:
-                    subtotal = invoice.fields.get("SubTotal")
-                    if subtotal:
-                        st.metric("Subtotal", subtotal.get('content'))
+    if not duplicate_of:
+        return ""
+    kind = "copy" if duplicate_of["exact"] else "near-duplicate"
+    return f"page {duplicate_of['page_num']} of {os.path.basename(duplicate_of['document'])} ({kind})"
 
-                    total_tax = invoice.fields.get("TotalTax")
-                    if total_tax:
-                        st.metric("Total Tax", total_tax.get('content'))
 
-                with col2:
-                    previous_unpaid_balance = invoice.fields.get(
-                        "PreviousUnpaidBalance")
-                    if previous_unpaid_balance:
-                        st.metric("Previous Unpaid Balance",
-                                  previous_unpaid_balance.get('content'))
-
-                    amount_due = invoice.fields.get("AmountDue")
-                    if amount_due:
-                        st.metric("Amount Due", amount_due.get('content'))
-
-                with col3:
-                    service_start_date = invoice.fields.get("ServiceStartDate")
-                    if service_start_date:
-                        st.markdown(
-                            f"**Service Start:** {service_start_date.get('content')}")
+def show_value(label: str, value) -> None:
+    """ Display a labelled value if it was extracted. """
 
-                    service_end_date = invoice.fields.get("ServiceEndDate")
-                    if service_end_date:
-                        st.markdown(
-                            f"**Service End:** {service_end_date.get('content')}")
-
-                # Additional Addresses
-                service_address = invoice.fields.get("ServiceAddress")
-                service_address_recipient = invoice.fields.get(
-                    "ServiceAddressRecipient")
-                remittance_address = invoice.fields.get("RemittanceAddress")
-                remittance_address_recipient = invoice.fields.get(
-                    "RemittanceAddressRecipient")
-
-                if service_address or service_address_recipient or remittance_address or remittance_address_recipient:
-                    st.divider()
-                    st.markdown("#### 📮 Additional Addresses")
-                    col1, col2 = st.columns(2)
-
-                    with col1:
-                        if service_address:
-                            st.markdown(
-                                f"**Service Address:** {service_address.get('content')}")
-                        if service_address_recipient:
-                            st.markdown(
-                                f"**Service Recipient:** {service_address_recipient.get('content')}")
-
-                    with col2:
-                        if remittance_address:
-                            st.markdown(
-                                f"**Remittance Address:** {remittance_address.get('content')}")
-                        if remittance_address_recipient:
-                            st.markdown(
-                                f"**Remittance Recipient:** {remittance_address_recipient.get('content')}")
+    if value:
+        st.markdown(f"**{label}:** {value}")
 
-            st.divider()
+
+def show_address(label: str, recipient_label: str, address: Union[Address, None]) -> None:
+    """ Display an address block and its recipient if they were extracted. """
+
+    if address:
+        show_value(label, address.content)
+        show_value(recipient_label, address.recipient)
 
 
 # Process selected invoice
 def process_invoice(file_name: str):
-    """ Process the selected invoice: preprocess and extract content. 
+    """ Process the selected invoice: preprocess and extract content.
+    Pages and their invoices are displayed as soon as they are classified and
+    extracted, while the rest of the document is still being processed. Once
+    done, the placeholder gallery is replaced in place by the paginated one,
+    and the results are kept in the session, see show_processed_invoice.
     Args:
         file_name (str): The name of the selected invoice file.
     Returns:
@@ -341,19 +315,113 @@ def process_invoice(file_name: str):
 
     # Start processing
     st.info(f"Processing document **{file_name}** started...")
-
-    # Convert PDF to images
+    started = time.perf_counter()
     pdf_path = os.path.join(docs_folder, file_name)
-    pages = foundry_service.pre_process_pdf(pdf_path)
+    page_count = get_pdf_page_count(pdf_path) or 0
+    version = os.stat(pdf_path).st_mtime_ns
+
+    # Placeholders for the first gallery page and for the invoices of every page, filled in as results arrive
+    pages_area = st.empty()
+    with pages_area.container():
+        st.subheader("Document Pages")
+        page_slots = gallery_slots(list(range(1, min(page_count, GALLERY_PAGE_SIZE) + 1)))
+        for page_num, slot in page_slots.items():
+            with slot.container():
+                show_page_tile(pdf_path, version, page_num, None)
+    progress = st.progress(0.0, text="Classifying pages...")
+    st.subheader("Extracted Invoices")
+    invoice_slots = {page_num: st.empty() for page_num in range(1, page_count + 1)}
+    pages_by_num = {}
+
+    def on_page(page: dict) -> None:
+        pages_by_num[page["page_num"]] = page
+        with metrics.span("render"):
+            if page["page_num"] in page_slots:
+                with page_slots[page["page_num"]].container():
+                    show_page_tile(pdf_path, version, page["page_num"], page)
+            progress.progress(len(pages_by_num) / max(page_count, 1),
+                              text=f"Classified {len(pages_by_num)} of {page_count} pages...")
+
+    def on_invoices(page_num: int, invoices: list) -> None:
+        with metrics.span("render"):
+            with invoice_slots.get(page_num, st.empty()).container():
+                show_page_invoices(pages_by_num.get(page_num, {"page_num": page_num}), invoices)
+
+    async def run() -> tuple:
+        try:
+            return await classify_and_extract(foundry_service, document_intelligence_service, pdf_path,
+                                              on_page=on_page, on_invoices=on_invoices)
+        finally:
+            # The async client is bound to this run's event loop
+            await document_intelligence_service.close()
+
+    with metrics.collect() as timings:
+        # Classify the pages and extract each invoice page as soon as it is classified
+        pages, invoices_by_page = asyncio.run(run())
+        progress.empty()
+
+        # Keep the extracted invoices for reporting once the page is rerun
+        if invoice_exporter:
+            with metrics.span("export"):
+                invoice_exporter.add(file_name, [invoice for _, invoices in sorted(invoices_by_page.items())
+                                                 for invoice in invoices])
+                invoice_exporter.flush()
+    metrics.export()
+
+    # Keep the results for later reruns, and swap in the paginated gallery;
+    # the invoices already shown stay as they are
+    processed = {
+        "file_name": file_name,
+        "pages": pages,
+        "invoices_by_page": invoices_by_page,
+        "timings": timings,
+        "elapsed": time.perf_counter() - started,
+    }
+    st.session_state["processed"] = processed
+    st.session_state["gallery_page"] = 1
+    st.session_state["full_page"] = None
+    with pages_area.container():
+        show_document_pages(pdf_path, pages)
+
+    # Processing completed
+    st.success(f"Processing document **{file_name}** completed.")
+    show_timing_breakdown(processed["timings"], processed["elapsed"])
+
+
+def show_processed_invoice(processed: dict) -> None:
+    """ Display the results of the last processed document.
+    Args:
+        processed (dict): The results kept in the session by process_invoice.
+    Returns:
+        None
+    """
 
-    # Show preprocessing results
-    show_preprocessing_results(pages)
+    pdf_path = os.path.join(docs_folder, processed["file_name"])
+    show_document_pages(pdf_path, processed["pages"])
 
-    # Extract and display content from the invoices
-    extract_content_from_invoices(file_name, pages)
+    st.subheader("Extracted Invoices")
+    for page in processed["pages"]:
+        if page["is_invoice"]:
+            show_page_invoices(page, processed["invoices_by_page"].get(page["page_num"], []))
 
     # Processing completed
-    st.success(f"Processing document **{file_name}** completed.")
+    st.success(f"Processing document **{processed['file_name']}** completed.")
+    show_timing_breakdown(processed["timings"], processed["elapsed"])
+
+
+# Show timing breakdown
+def show_timing_breakdown(timings: StageTimings, elapsed: float) -> None:
+    """ Display how long each pipeline stage took for the processed document.
+    Args:
+        timings (StageTimings): The stage timings collected while processing.
+        elapsed (float): The wall-clock processing time in seconds.
+    Returns:
+        None
+    """
+
+    with st.expander(f"⏱️ Timing breakdown ({elapsed:.2f} s wall clock)"):
+        st.caption("Stages run concurrently, so their totals can add up to more than the wall-clock time.")
+        st.dataframe(pd.DataFrame(timings.rows()))
 
 
 def main():
@@ -368,14 +436,26 @@ def main():
         load_invoice_records()
 
     # Show table if loaded
-    if "invoice_df" in st.session_state:
+    if "invoice_scan" in st.session_state:
         st.subheader("Invoices Table")
-        st.success(
-            f"Loaded {len(st.session_state['invoice_df'])} invoices from local folder.")
-        st.dataframe(st.session_state["invoice_df"])
+        name_filter = st.text_input("Filter by name:", key="invoice_filter")
+        total = folder_index.count(docs_folder, name_filter)
+        st.success(f"Loaded {total} invoices from local folder.")
+
+        # Only the current page of the table is read from the index
+        table_pages = max(1, -(-total // INVOICE_TABLE_PAGE_SIZE))
+        table_page = 1
+        if table_pages > 1:
+            # A narrower filter can leave fewer pages than the one selected
+            if st.session_state.get("invoice_table_page", 1) > table_pages:
+                st.session_state["invoice_table_page"] = table_pages
+            table_page = st.number_input(
+                f"Table page (of {table_pages})", min_value=1, max_value=table_pages, key="invoice_table_page")
+        df = pd.DataFrame(folder_index.list(
+            docs_folder, (table_page - 1) * INVOICE_TABLE_PAGE_SIZE, INVOICE_TABLE_PAGE_SIZE, name_filter))
+        st.dataframe(df)
 
         # Get unique item names from the dataframe
-        df = st.session_state["invoice_df"]
         if "Name" in df.columns and len(df) > 0:
             item_names = df["Name"].unique().tolist()
 
@@ -387,8 +467,11 @@ def main():
             )
 
             # Add Process button
+            processed = st.session_state.get("processed")
             if st.button("⚙️ Process"):
                 process_invoice(selected_item)
+            elif processed and processed["file_name"] == selected_item:
+                show_processed_invoice(processed)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,374 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import fitz  # PyMuPDF is used to generate the synthetic PDFs
+from azure.ai.documentintelligence.models import AnalyzeResult
+from simulated_results import simulated_invoice
+
+# Text of a synthetic digital invoice page
+INVOICE_TEXT = """INVOICE
+Invoice Number: INV-{number:05d}    Invoice Date: 2024-03-{day:02d}    Due Date: 2024-04-{day:02d}
+Bill To: Contoso Ltd, 1 Main Street, Springfield
+Vendor: Fabrikam Inc, 42 Market Road, Shelbyville
+
+Description                 Qty    Unit Price      Amount
+{lines}
+
+Subtotal: {subtotal:,.2f}
+VAT 20%: {tax:,.2f}
+Total Due: {total:,.2f} USD
+Payment terms: 30 days. Remit to: Fabrikam Inc."""
+
+# Text of a synthetic non-invoice page (cover letters, terms and conditions)
+OTHER_TEXT = """Dear customer,
+Thank you for your continued business. Please find enclosed the documents
+relating to your recent order. Should you have any questions regarding the
+delivery schedule or the enclosed material, do not hesitate to contact our
+customer service team. We look forward to working with you again and wish
+you a pleasant day. Kind regards, the customer service team."""
+
+
+class SimulatedHttpError(Exception):
+    """ Error shaped like an SDK HTTP error, so the rate limiter treats it as throttling. """
+
+    class _Response:
+        def __init__(self, status_code: int, headers: dict):
+            self.status_code = status_code
+            self.headers = headers
+
+    def __init__(self, status_code: int, retry_after: float = None):
+        super().__init__(f"Simulated HTTP {status_code}")
+        self.status_code = status_code
+        headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+        self.response = self._Response(status_code, headers)
+
+
+class _Usage:
+    def __init__(self, input_token_count: int, output_token_count: int):
+        self.input_token_count = input_token_count
+        self.output_token_count = output_token_count
+
+
+class _Response:
+    def __init__(self, text: str, input_tokens: int, output_tokens: int):
+        self.text = text
+        self.usage_details = _Usage(input_tokens, output_tokens)
+
+
+class SimulatedAgent:
+    """ Stand-in for the FoundryService agent with configurable latency,
+    jitter and throttling. Verdicts are derived from a hash of each image,
+    so they are stable across runs.
+    """
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.1, throttle_rate: float = 0.0,
+                 retry_after: float = 1.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.calls = 0
+
+    async def run(self, messages) -> _Response:
+        self.calls += 1
+        images = [content.data for content in messages.contents if hasattr(content, "data")]
+        await asyncio.sleep(max(0.0, self.latency * len(images) ** 0.5 + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.throttle_rate:
+            raise SimulatedHttpError(429, self.retry_after)
+
+        verdicts = [hashlib.sha256(image).digest()[0] % 2 == 0 for image in images]
+        input_tokens = sum(85 + len(image) // 750 for image in images) + 60
+        page_labels = [content.text.split()[1].rstrip(":") for content in messages.contents
+                       if getattr(content, "text", "").startswith("Page ")]
+        if page_labels:
+            text = json.dumps([{"page": int(page), "is_invoice": verdict}
+                               for page, verdict in zip(page_labels, verdicts)])
+            return _Response(text, input_tokens, 12 * len(images))
+        return _Response("Yes" if verdicts[0] else "No", input_tokens, 1)
+
+
+class _SimulatedPoller:
+    def __init__(self, client: "SimulatedDocumentIntelligenceClient", page_count: int):
+        self.client = client
+        self.page_count = page_count
+
+    def continuation_token(self) -> str:
+        # Simulated polls never fail, so the operation is never resumed
+        return ""
+
+    def result(self) -> AnalyzeResult:
+        time.sleep(self._latency())
+        return self._analyze_result()
+
+    def _latency(self) -> float:
+        return max(0.0, self.client.latency + random.uniform(-self.client.jitter, self.client.jitter))
+
+    def _analyze_result(self) -> AnalyzeResult:
+        return AnalyzeResult({
+            "modelId": "prebuilt-invoice",
+            "pages": [{"pageNumber": page_num, "spans": []} for page_num in range(1, self.page_count + 1)],
+            "documents": [simulated_invoice(page_num) for page_num in range(1, self.page_count + 1)]
+        })
+
+
+class _AsyncSimulatedPoller(_SimulatedPoller):
+    async def result(self) -> AnalyzeResult:
+        await asyncio.sleep(self._latency())
+        return self._analyze_result()
+
+
+class SimulatedDocumentIntelligenceClient:
+    """ Stand-in for DocumentIntelligenceClient: returns one invoice per
+    uploaded page after a configurable LRO latency, and can throttle.
+    """
+
+    def __init__(self, latency: float = 2.0, jitter: float = 0.5, throttle_rate: float = 0.0,
+                 retry_after: float = 1.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.calls = 0
+        self.bytes_received = 0
+
+    def begin_analyze_document(self, model_id: str, body, **kwargs) -> _SimulatedPoller:
+        self.calls += 1
+        if random.random() < self.throttle_rate:
+            raise SimulatedHttpError(429, self.retry_after)
+        document_bytes = body.bytes_source
+        self.bytes_received += len(document_bytes)
+        from utils import get_pdf_page_count
+        return _SimulatedPoller(self, get_pdf_page_count(document_bytes) or 0)
+
+
+class AsyncSimulatedDocumentIntelligenceClient(SimulatedDocumentIntelligenceClient):
+    """ Stand-in for the aio DocumentIntelligenceClient: the LRO latency is
+    awaited, so many analyses can be in flight on one event loop.
+    """
+
+    async def begin_analyze_document(self, model_id: str, body, **kwargs) -> _AsyncSimulatedPoller:
+        poller = super().begin_analyze_document(model_id, body, **kwargs)
+        return _AsyncSimulatedPoller(self, poller.page_count)
+
+
+def generate_pdf(path: str, page_count: int, invoice_ratio: float = 0.5, scanned_ratio: float = 0.5,
+                 seed: int = 0) -> None:
+    """ Generate a synthetic PDF mixing invoice and non-invoice pages.
+    Scanned pages carry only an image and no text layer, so they cannot be
+    decided by the local text classifier and go to the (simulated) model.
+    Args:
+        path (str): Where to write the PDF.
+        page_count (int): The number of pages.
+        invoice_ratio (float): Fraction of invoice pages.
+        scanned_ratio (float): Fraction of pages rendered as scanned images.
+        seed (int): Random seed, so the same arguments produce the same document.
+    """
+
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for page_index in range(page_count):
+        if rng.random() < invoice_ratio:
+            amounts = [round(rng.uniform(10, 500), 2) for _ in range(rng.randint(2, 8))]
+            lines = "\n".join(f"Item {idx + 1:<22} 1      {amount:>10,.2f}  {amount:>10,.2f}"
+                              for idx, amount in enumerate(amounts))
+            subtotal = sum(amounts)
+            text = INVOICE_TEXT.format(number=seed * 1000 + page_index, day=page_index % 28 + 1, lines=lines,
+                                       subtotal=subtotal, tax=subtotal * 0.2, total=subtotal * 1.2)
+        else:
+            text = OTHER_TEXT
+
+        page = doc.new_page()
+        page.insert_text((50, 72), text, fontsize=10)
+        if rng.random() < scanned_ratio:
+            # Replace the page with a rasterized copy that has no text layer
+            pix = page.get_pixmap(dpi=100, colorspace=fitz.csGRAY)
+            doc.delete_page(page.number)
+            scanned = doc.new_page(pno=page_index)
+            scanned.insert_image(scanned.rect, stream=pix.tobytes("png"))
+    doc.save(path)
+    doc.close()
+
+
+def _percentile(values: list, q: float) -> float:
+    """ Return the q-quantile of values using the nearest-rank method. """
+
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))]
+
+
+def _peak_rss_mb() -> float:
+    """ Return the peak resident set size of this process in MB. """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _run_configuration(config: dict) -> dict:
+    """ Run one benchmark configuration; executed in a fresh process so that
+    peak RSS is measured per configuration.
+    Args:
+        config (dict): The documents, concurrency, render profile and simulated backend settings.
+    Returns:
+        dict: Pages per second, document latency percentiles, peak RSS and call counts.
+    """
+
+    # Measure the pipeline itself, not the caches
+    os.environ["CLASSIFICATION_CACHE_PATH"] = ""
+    os.environ["ANALYZE_CACHE_PATH"] = ""
+    # The synthetic pages share a few layouts, so duplicate detection would skip most model calls
+    os.environ["DUPLICATE_DETECTION"] = "false"
+    os.environ["CLASSIFICATION_BATCH_SIZE"] = str(config["batch_size"])
+    from foundry_service import FoundryService
+    from doc_intel_service import DocumentIntelligenceService
+    from rate_limiter import AdaptiveRateLimiter
+    from pipeline import process_document
+
+    random.seed(config["seed"])
+    agent = SimulatedAgent(config["latency"], config["jitter"], config["throttle_rate"])
+    client = AsyncSimulatedDocumentIntelligenceClient(
+        config["di_latency"], config["di_jitter"], config["throttle_rate"])
+    foundry_service = FoundryService(max_concurrency=config["concurrency"], agent=agent)
+    foundry_service.render_profile = config["profile"]
+    foundry_service.rate_limiter = AdaptiveRateLimiter(
+        "AZURE_OPENAI", max_concurrency=config["concurrency"], backoff_base=0.1)
+    document_intelligence_service = DocumentIntelligenceService(client=client, aio_client=client)
+    document_intelligence_service.rate_limiter = AdaptiveRateLimiter(
+        "DOCUMENT_INTELLIGENCE", max_concurrency=config["concurrency"], backoff_base=0.1)
+    document_intelligence_service.log_output = lambda invoices: None
+
+    async def run_all() -> list:
+        semaphore = asyncio.Semaphore(config["max_documents"])
+
+        async def run(path: str) -> dict:
+            async with semaphore:
+                return await process_document(foundry_service, document_intelligence_service, path)
+
+        return await asyncio.gather(*(run(path) for path in config["documents"]))
+
+    started = time.perf_counter()
+    records = asyncio.run(run_all())
+    elapsed = time.perf_counter() - started
+
+    pages = sum(len(record["pages"]) for record in records)
+    latencies = [record["timings"]["total_s"] for record in records]
+    return {
+        "concurrency": config["concurrency"],
+        "profile": config["profile"],
+        "batch_size": config["batch_size"],
+        "documents": len(records),
+        "pages": pages,
+        "elapsed_s": round(elapsed, 3),
+        "pages_per_s": round(pages / elapsed, 3),
+        "p50_latency_s": round(_percentile(latencies, 0.5), 3),
+        "p95_latency_s": round(_percentile(latencies, 0.95), 3),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "model_calls": agent.calls,
+        "analyze_calls": client.calls,
+        "uploaded_kb": round(client.bytes_received / 1024, 1)
+    }
+
+
+def compare_to_baseline(results: list, baseline: list, tolerance: float) -> list:
+    """ Return the configurations whose throughput regressed beyond the tolerance.
+    Args:
+        results (list): The current benchmark results.
+        baseline (list): Results of a previous run, as written by --json-output.
+        tolerance (float): Allowed relative drop in pages per second, e.g. 0.2 for 20%.
+    Returns:
+        list: One message per regressed configuration.
+    """
+
+    def key(result: dict) -> tuple:
+        return result["concurrency"], result["profile"], result["batch_size"]
+
+    previous = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = previous.get(key(result))
+        if reference and result["pages_per_s"] < reference["pages_per_s"] * (1 - tolerance):
+            regressions.append(
+                f"concurrency={result['concurrency']} profile={result['profile']} batch={result['batch_size']}: "
+                f"{result['pages_per_s']} pages/s vs baseline {reference['pages_per_s']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the invoice pipeline offline against simulated Azure backends.")
+    parser.add_argument("--documents", type=int, default=8, help="Number of synthetic documents")
+    parser.add_argument("--pages", default="1,5,20", help="Comma-separated page counts, cycled over documents")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--profiles", default="classification,display", help="Comma-separated render profiles")
+    parser.add_argument("--batch-size", type=int, default=1, help="Pages per classification request")
+    parser.add_argument("--max-documents", type=int, default=2, help="Documents processed at once")
+    parser.add_argument("--scanned-ratio", type=float, default=0.5, help="Fraction of scanned pages")
+    parser.add_argument("--latency", type=float, default=0.5, help="Simulated model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Simulated model latency jitter in seconds")
+    parser.add_argument("--di-latency", type=float, default=2.0, help="Simulated analyze latency in seconds")
+    parser.add_argument("--di-jitter", type=float, default=0.5, help="Simulated analyze latency jitter in seconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probability of a simulated HTTP 429")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--json-output", help="Write the results as JSON, e.g. to use as a baseline")
+    parser.add_argument("--baseline", help="Fail if throughput regressed against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative throughput drop")
+    args = parser.parse_args()
+
+    page_counts = [int(pages) for pages in args.pages.split(",")]
+    with tempfile.TemporaryDirectory() as folder:
+        documents = []
+        for idx in range(args.documents):
+            path = os.path.join(folder, f"synthetic_{idx:03d}.pdf")
+            generate_pdf(path, page_counts[idx % len(page_counts)], scanned_ratio=args.scanned_ratio,
+                         seed=args.seed + idx)
+            documents.append(path)
+
+        results = []
+        context = multiprocessing.get_context("spawn")
+        for profile in args.profiles.split(","):
+            for concurrency in (int(level) for level in args.concurrency.split(",")):
+                config = {
+                    "documents": documents,
+                    "concurrency": concurrency,
+                    "profile": profile,
+                    "batch_size": args.batch_size,
+                    "max_documents": args.max_documents,
+                    "latency": args.latency,
+                    "jitter": args.jitter,
+                    "di_latency": args.di_latency,
+                    "di_jitter": args.di_jitter,
+                    "throttle_rate": args.throttle_rate,
+                    "seed": args.seed
+                }
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    result = executor.submit(_run_configuration, config).result()
+                results.append(result)
+                print(f"profile={result['profile']:<15} concurrency={result['concurrency']:<3} "
+                      f"pages/s={result['pages_per_s']:<8} p50={result['p50_latency_s']}s "
+                      f"p95={result['p95_latency_s']}s peak RSS={result['peak_rss_mb']} MB "
+                      f"model calls={result['model_calls']} analyze calls={result['analyze_calls']}")
+
+    if args.json_output:
+        with open(args.json_output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Union
+
+
+class ClassificationCache:
+    """ Persistent, size-bounded LRU cache for page classification results.
+    Entries are keyed by a hash of the rendered page, the prompt and the
+    model deployment name, so any change to one of them is a cache miss.
+    """
+
+    def __init__(self, db_path: str, max_entries: int = 10000):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS classifications (
+                key TEXT PRIMARY KEY,
+                is_invoice INTEGER NOT NULL,
+                input_tokens INTEGER NOT NULL,
+                output_tokens INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(image_bytes: bytes, prompt: str, deployment_name: str) -> str:
+        """ Build the cache key for a rendered page.
+        Args:
+            image_bytes (bytes): The rendered page image.
+            prompt (str): The classification prompt.
+            deployment_name (str): The model deployment name.
+        Returns:
+            str: The hex digest identifying the classification request.
+        """
+
+        digest = hashlib.sha256()
+        for part in (image_bytes, prompt.encode("utf-8"), deployment_name.encode("utf-8")):
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Union[dict, None]:
+        """ Return the cached verdict and token counts for a key, or None.
+        Args:
+            key (str): The cache key from make_key.
+        Returns:
+            Union[dict, None]: The cached result, or None on a miss.
+        """
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT is_invoice, input_tokens, output_tokens FROM classifications WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE classifications SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return {
+            "is_invoice": bool(row[0]),
+            "input_tokens": row[1],
+            "output_tokens": row[2]
+        }
+
+    def put(self, key: str, is_invoice: bool, input_tokens: int, output_tokens: int) -> None:
+        """ Store a classification result and evict the least recently used
+        entries beyond the size limit.
+        Args:
+            key (str): The cache key from make_key.
+            is_invoice (bool): The classification verdict.
+            input_tokens (int): Input tokens used by the model call.
+            output_tokens (int): Output tokens used by the model call.
+        """
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO classifications VALUES (?, ?, ?, ?, ?)",
+                (key, int(is_invoice), int(input_tokens or 0), int(output_tokens or 0), time.time()))
+            self._conn.execute(
+                """DELETE FROM classifications WHERE key IN (
+                    SELECT key FROM classifications ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )""", (self.max_entries,))
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        """ Return hit/miss counters and the current number of entries.
+        Returns:
+            dict: A dictionary with hits, misses and entries.
+        """
+
+        with self._lock:
+            entries = self._conn.execute(
+                "SELECT COUNT(*) FROM classifications").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
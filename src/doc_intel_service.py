@@ -1,221 +1,103 @@
 import os
+import json
+import time
+import asyncio
+from collections.abc import MutableMapping
+from typing import Union
 from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AioDefaultAzureCredential
 from azure.core.credentials import AzureKeyCredential
+from azure.core.polling import AsyncLROPoller, LROPoller
 from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient as AioDocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeDocumentRequest, AnalyzeResult, DocumentAnalysisFeature
+from utils import extract_pdf_pages
+from invoice_model import Invoice, normalize_invoice
+from analyze_cache import AnalyzeResultCache
+from rate_limiter import get_rate_limiter
+from metrics import metrics
 
 
 from dotenv import load_dotenv
 load_dotenv(override=True)
 
 
+def _remap_page_numbers(node, page_map: dict[int, int]) -> None:
+    """Rewrite every pageNumber in an analysis result in place.
+    Args:
+        node: The AnalyzeResult or any nested model, dict or list.
+        page_map (dict[int, int]): Subset page number mapped to original page number.
+    """
+
+    if isinstance(node, MutableMapping):
+        for key, value in node.items():
+            if key == "pageNumber" and isinstance(value, int):
+                node[key] = page_map.get(value, value)
+            else:
+                _remap_page_numbers(value, page_map)
+    elif isinstance(node, list):
+        for item in node:
+            _remap_page_numbers(item, page_map)
+
+
+# Default location of the on-disk analysis result cache
+DEFAULT_CACHE_PATH = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), "..", ".cache", "analyze_results.sqlite"))
+
+
 class DocumentIntelligenceService:
-    def __init__(self):
+    def __init__(self, cache: AnalyzeResultCache = None, client: DocumentIntelligenceClient = None,
+                 aio_client: AioDocumentIntelligenceClient = None):
+        self.model_id = "prebuilt-invoice"
         self.endpoint = os.getenv("DOCUMENT_INTELLIGENCE_API_ENDPOINT")
         self.key = os.getenv("DOCUMENT_INTELLIGENCE_API_KEY")
-        self.client = DocumentIntelligenceClient(
+        # Set AZURE_AUTH_MODE=key to use API key authentication instead of Azure AD authentication
+        use_key = os.getenv("AZURE_AUTH_MODE", "aad").lower() == "key"
+        # A client can be injected, e.g. a simulated one for offline benchmarks.
+        # The SDK's own retries are turned off, so every throttled analyze request
+        # reaches the shared rate limiter, which retries it and adapts the concurrency.
+        # Failed status polls are retried by resuming the operation, see _poll
+        self.client = client or DocumentIntelligenceClient(
             endpoint=self.endpoint,
-            credential=DefaultAzureCredential() # Comment this line and uncomment the line below to use API key authentication instead of Azure AD authentication
-            #credential=AzureKeyCredential(self.key) # Uncomment this line to use API key authentication instead of Azure AD authentication
+            credential=AzureKeyCredential(self.key) if use_key else DefaultAzureCredential(),
+            retry_total=0
         )
+        # The async client is bound to an event loop, so it is created on first use in each loop.
+        # The factory also returns the aio credential, which holds its own session and must be closed
+        def create_aio_client() -> tuple:
+            credential = AzureKeyCredential(self.key) if use_key else AioDefaultAzureCredential()
+            client = AioDocumentIntelligenceClient(endpoint=self.endpoint, credential=credential, retry_total=0)
+            return client, None if use_key else credential
+
+        self._aio_client_factory = (lambda: (aio_client, None)) if aio_client else create_aio_client
+        self._aio_client = None
+        self._aio_credential = None
+        self._aio_client_loop = None
+        # Verbose per-invoice logging is opt-in, as it writes to stdout on the request path
+        self.log_invoices = os.getenv("DOCUMENT_INTELLIGENCE_LOG_OUTPUT", "false").lower() == "true"
+        # Seconds between status polls of a running analysis, unless the service sends Retry-After
+        self.polling_interval = float(os.getenv("DOCUMENT_INTELLIGENCE_POLLING_INTERVAL", "1"))
+        # Shared scheduler enforcing the Document Intelligence request budget
+        self.rate_limiter = get_rate_limiter("DOCUMENT_INTELLIGENCE")
+        # Cache of previous analysis results, disabled when ANALYZE_CACHE_PATH is empty
+        cache_path = os.getenv("ANALYZE_CACHE_PATH", DEFAULT_CACHE_PATH)
+        self.cache = cache or (AnalyzeResultCache(
+            cache_path,
+            ttl_seconds=int(os.getenv("ANALYZE_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+            max_bytes=int(os.getenv("ANALYZE_CACHE_MAX_MB", "500")) * 1024 * 1024
+        ) if cache_path else None)
 
-    def log_output(self, invoices: AnalyzeResult) -> None:       
-        """Log detailed invoice analysis output
+    def log_output(self, invoices: list[Invoice]) -> None:
+        """Log the analyzed invoices as one JSON line each, when enabled
+        with DOCUMENT_INTELLIGENCE_LOG_OUTPUT=true.
         Args:
-            invoices (AnalyzeResult): The analysis result object.        
+            invoices (list[Invoice]): The normalized invoices.
         """
-        
-        if invoices.documents:
-            for idx, invoice in enumerate(invoices.documents):
-                print(f"--------Analyzing invoice #{idx + 1}--------")
-                vendor_name = invoice.fields.get("VendorName")
-                if vendor_name:
-                    print(
-                        f"Vendor Name: {vendor_name.get('content')} (confidence: {vendor_name.get('confidence')})"
-                    )
-                vendor_address = invoice.fields.get("VendorAddress")
-                if vendor_address:
-                    print(
-                        f"Vendor Address: {vendor_address.get('content')} (confidence: {vendor_address.get('confidence')})"
-                    )
-                vendor_address_recipient = invoice.fields.get(
-                    "VendorAddressRecipient")
-                if vendor_address_recipient:
-                    print(
-                        f"Vendor Address Recipient: {vendor_address_recipient.get('content')} (confidence: {vendor_address_recipient.get('confidence')})"
-                    )
-                customer_name = invoice.fields.get("CustomerName")
-                if customer_name:
-                    print(
-                        f"Customer Name: {customer_name.get('content')} (confidence: {customer_name.get('confidence')})"
-                    )
-                customer_id = invoice.fields.get("CustomerId")
-                if customer_id:
-                    print(
-                        f"Customer Id: {customer_id.get('content')} (confidence: {customer_id.get('confidence')})"
-                    )
-                customer_address = invoice.fields.get("CustomerAddress")
-                if customer_address:
-                    print(
-                        f"Customer Address: {customer_address.get('content')} (confidence: {customer_address.get('confidence')})"
-                    )
-                customer_address_recipient = invoice.fields.get(
-                    "CustomerAddressRecipient")
-                if customer_address_recipient:
-                    print(
-                        f"Customer Address Recipient: {customer_address_recipient.get('content')} (confidence: {customer_address_recipient.get('confidence')})"
-                    )
-                invoice_id = invoice.fields.get("InvoiceId")
-                if invoice_id:
-                    print(
-                        f"Invoice Id: {invoice_id.get('content')} (confidence: {invoice_id.get('confidence')})"
-                    )
-                invoice_date = invoice.fields.get("InvoiceDate")
-                if invoice_date:
-                    print(
-                        f"Invoice Date: {invoice_date.get('content')} (confidence: {invoice_date.get('confidence')})"
-                    )
-                invoice_total = invoice.fields.get("InvoiceTotal")
-                if invoice_total:
-                    print(
-                        f"Invoice Total: {invoice_total.get('content')} (confidence: {invoice_total.get('confidence')})"
-                    )
-                due_date = invoice.fields.get("DueDate")
-                if due_date:
-                    print(
-                        f"Due Date: {due_date.get('content')} (confidence: {due_date.get('confidence')})"
-                    )
-                purchase_order = invoice.fields.get("PurchaseOrder")
-                if purchase_order:
-                    print(
-                        f"Purchase Order: {purchase_order.get('content')} (confidence: {purchase_order.get('confidence')})"
-                    )
-                billing_address = invoice.fields.get("BillingAddress")
-                if billing_address:
-                    print(
-                        f"Billing Address: {billing_address.get('content')} (confidence: {billing_address.get('confidence')})"
-                    )
-                billing_address_recipient = invoice.fields.get(
-                    "BillingAddressRecipient")
-                if billing_address_recipient:
-                    print(
-                        f"Billing Address Recipient: {billing_address_recipient.get('content')} (confidence: {billing_address_recipient.get('confidence')})"
-                    )
-                shipping_address = invoice.fields.get("ShippingAddress")
-                if shipping_address:
-                    print(
-                        f"Shipping Address: {shipping_address.get('content')} (confidence: {shipping_address.get('confidence')})"
-                    )
-                shipping_address_recipient = invoice.fields.get(
-                    "ShippingAddressRecipient")
-                if shipping_address_recipient:
-                    print(
-                        f"Shipping Address Recipient: {shipping_address_recipient.get('content')} (confidence: {shipping_address_recipient.get('confidence')})"
-                    )
-                print("Invoice items:")
-                for idx, item in enumerate(invoice.fields.get("Items").get("valueArray")):
-                    print(f"...Item #{idx + 1}")
-                    item_description = item.get(
-                        "valueObject").get("Description")
-                    if item_description:
-                        print(
-                            f"......Description: {item_description.get('content')} (confidence: {item_description.get('confidence')})"
-                        )
-                    item_quantity = item.get("valueObject").get("Quantity")
-                    if item_quantity:
-                        print(
-                            f"......Quantity: {item_quantity.get('content')} (confidence: {item_quantity.get('confidence')})"
-                        )
-                    unit = item.get("valueObject").get("Unit")
-                    if unit:
-                        print(
-                            f"......Unit: {unit.get('content')} (confidence: {unit.get('confidence')})"
-                        )
-                    unit_price = item.get("valueObject").get("UnitPrice")
-                    if unit_price:
-                        unit_price_code = (
-                            unit_price.get("valueCurrency").get("currencyCode")
-                            if unit_price.get("valueCurrency").get("currencyCode")
-                            else ""
-                        )
-                        print(
-                            f"......Unit Price: {unit_price.get('content')}{unit_price_code} (confidence: {unit_price.get('confidence')})"
-                        )
-                    product_code = item.get("valueObject").get("ProductCode")
-                    if product_code:
-                        print(
-                            f"......Product Code: {product_code.get('content')} (confidence: {product_code.get('confidence')})"
-                        )
-                    item_date = item.get("valueObject").get("Date")
-                    if item_date:
-                        print(
-                            f"......Date: {item_date.get('content')} (confidence: {item_date.get('confidence')})"
-                        )
-                    tax = item.get("valueObject").get("Tax")
-                    if tax:
-                        print(
-                            f"......Tax: {tax.get('content')} (confidence: {tax.get('confidence')})"
-                        )
-                    amount = item.get("valueObject").get("Amount")
-                    if amount:
-                        print(
-                            f"......Amount: {amount.get('content')} (confidence: {amount.get('confidence')})"
-                        )
-                subtotal = invoice.fields.get("SubTotal")
-                if subtotal:
-                    print(
-                        f"Subtotal: {subtotal.get('content')} (confidence: {subtotal.get('confidence')})"
-                    )
-                total_tax = invoice.fields.get("TotalTax")
-                if total_tax:
-                    print(
-                        f"Total Tax: {total_tax.get('content')} (confidence: {total_tax.get('confidence')})"
-                    )
-                previous_unpaid_balance = invoice.fields.get(
-                    "PreviousUnpaidBalance")
-                if previous_unpaid_balance:
-                    print(
-                        f"Previous Unpaid Balance: {previous_unpaid_balance.get('content')} (confidence: {previous_unpaid_balance.get('confidence')}"
-                    )
-                amount_due = invoice.fields.get("AmountDue")
-                if amount_due:
-                    print(
-                        f"Amount Due: {amount_due.get('content')} (confidence: {amount_due.get('confidence')})"
-                    )
-                service_start_date = invoice.fields.get("ServiceStartDate")
-                if service_start_date:
-                    print(
-                        f"Service Start Date: {service_start_date.get('content')} (confidence: {service_start_date.get('confidence')})"
-                    )
-                service_end_date = invoice.fields.get("ServiceEndDate")
-                if service_end_date:
-                    print(
-                        f"Service End Date: {service_end_date.get('content')} (confidence: {service_end_date.get('confidence')})"
-                    )
-                service_address = invoice.fields.get("ServiceAddress")
-                if service_address:
-                    print(
-                        f"Service Address: {service_address.get('content')} (confidence: {service_address.get('confidence')})"
-                    )
-                service_address_recipient = invoice.fields.get(
-                    "ServiceAddressRecipient")
-                if service_address_recipient:
-                    print(
-                        f"Service Address Recipient: {service_address_recipient.get('content')} (confidence: {service_address_recipient.get('confidence')})"
-                    )
-                remittance_address = invoice.fields.get("RemittanceAddress")
-                if remittance_address:
-                    print(
-                        f"Remittance Address: {remittance_address.get('content')} (confidence: {remittance_address.get('confidence')})"
-                    )
-                remittance_address_recipient = invoice.fields.get(
-                    "RemittanceAddressRecipient"
-                )
-                if remittance_address_recipient:
-                    print(
-                        f"Remittance Address Recipient: {remittance_address_recipient.get('content')} (confidence: {remittance_address_recipient.get('confidence')})"
-                    )
-            print("----------------------------------------")
+
+        if not self.log_invoices:
+            return
+        for invoice in invoices:
+            print(json.dumps({"event": "invoice_analyzed", "model_id": self.model_id, **invoice.to_dict()}))
 
     def analyze_document(self, document_bytes: bytes, pages: list[int]) -> AnalyzeResult:
         """Analyze document using Document Intelligence Service
@@ -226,16 +108,188 @@ class DocumentIntelligenceService:
             AnalyzeResult: The analysis result object.
         """       
 
-        poller = self.client.begin_analyze_document(
-            "prebuilt-invoice",
-            AnalyzeDocumentRequest(bytes_source=document_bytes),
-            pages=",".join(map(str, pages)),
-            # features=DocumentAnalysisFeature()
-        )
-        invoices = poller.result()
-        self.log_output(invoices)
+        pages, cache_key, cached = self._lookup(document_bytes, pages)
+        if cached:
+            return cached
+
+        # Upload only the requested pages instead of the whole document
+        subset_bytes = extract_pdf_pages(document_bytes, pages)
+
+        def begin() -> LROPoller:
+            with metrics.span("upload"):
+                return self.client.begin_analyze_document(
+                    self.model_id,
+                    AnalyzeDocumentRequest(bytes_source=subset_bytes),
+                    polling_interval=self.polling_interval,
+                    # features=DocumentAnalysisFeature()
+                )
+
+        # Only the billed analyze request runs under the shared rate limiter, which retries throttling
+        poller = self.rate_limiter.run_sync(begin)
+        metrics.increment("bytes_sent", len(subset_bytes), target="document_intelligence")
+        with metrics.span("lro_poll"):
+            invoices = self._poll(poller)
+        return self._store(invoices, pages, cache_key)
+
+    def _poll(self, poller: LROPoller) -> AnalyzeResult:
+        """Wait for an analyze operation. A status poll that fails with throttling or a
+        transient error resumes the same operation instead of starting a new one.
+        Args:
+            poller (LROPoller): The poller returned by begin_analyze_document.
+        Returns:
+            AnalyzeResult: The analysis result object.
+        """
+
+        continuation_token = poller.continuation_token()
+        attempt = 0
+        while True:
+            try:
+                return poller.result()
+            except Exception as e:
+                delay = self.rate_limiter.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                poller = self.client.begin_analyze_document(
+                    self.model_id, None, continuation_token=continuation_token,
+                    polling_interval=self.polling_interval)
+
+    async def analyze_document_async(self, document_bytes: bytes, pages: list[int]) -> AnalyzeResult:
+        """Analyze document using the async Document Intelligence client.
+        While the operation runs, polling only sleeps on the event loop, so
+        many analyses can be in flight at once.
+        Args:
+            document_bytes (bytes): The document content in bytes.
+            pages (list[int]): List of page numbers to analyze.
+        Returns:
+            AnalyzeResult: The analysis result object.
+        """
+
+        pages, cache_key, cached = self._lookup(document_bytes, pages)
+        if cached:
+            return cached
+
+        # Upload only the requested pages instead of the whole document
+        subset_bytes = await asyncio.to_thread(extract_pdf_pages, document_bytes, pages)
+        client = self._get_aio_client()
+
+        async def begin() -> AsyncLROPoller:
+            with metrics.span("upload"):
+                return await client.begin_analyze_document(
+                    self.model_id,
+                    AnalyzeDocumentRequest(bytes_source=subset_bytes),
+                    polling_interval=self.polling_interval,
+                )
+
+        # Only the billed analyze request runs under the shared rate limiter, which retries throttling
+        poller = await self.rate_limiter.run_async(begin)
+        metrics.increment("bytes_sent", len(subset_bytes), target="document_intelligence")
+        with metrics.span("lro_poll"):
+            invoices = await self._poll_async(client, poller)
+        return self._store(invoices, pages, cache_key)
+
+    async def _poll_async(self, client: AioDocumentIntelligenceClient, poller: AsyncLROPoller) -> AnalyzeResult:
+        """Async counterpart of _poll."""
+
+        continuation_token = poller.continuation_token()
+        attempt = 0
+        while True:
+            try:
+                return await poller.result()
+            except Exception as e:
+                delay = self.rate_limiter.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                poller = await client.begin_analyze_document(
+                    self.model_id, None, continuation_token=continuation_token,
+                    polling_interval=self.polling_interval)
+
+    def _get_aio_client(self) -> AioDocumentIntelligenceClient:
+        """Return the async client bound to the running event loop, creating it if needed."""
+
+        loop = asyncio.get_running_loop()
+        if self._aio_client is None or self._aio_client_loop is not loop:
+            self._aio_client, self._aio_credential = self._aio_client_factory()
+            self._aio_client_loop = loop
+        return self._aio_client
+
+    async def close(self) -> None:
+        """Close the async client and its credential, if they were created in the running event loop."""
+
+        if self._aio_client is not None and self._aio_client_loop is asyncio.get_running_loop():
+            await self._aio_client.close()
+            if self._aio_credential is not None:
+                await self._aio_credential.close()
+        self._aio_client = None
+        self._aio_credential = None
+        self._aio_client_loop = None
+
+    def _lookup(self, document_bytes: bytes, pages: list[int]) -> tuple[list[int], Union[str, None], Union[AnalyzeResult, None]]:
+        """Normalize the page list and look up a previous result for the same
+        document, pages and model.
+        Returns:
+            tuple: The sorted pages, the cache key and the cached result, if any.
+        """
+
+        pages = sorted(set(pages))
+        if not self.cache:
+            return pages, None, None
+        cache_key = AnalyzeResultCache.make_key(document_bytes, pages, self.model_id)
+        return pages, cache_key, self.cache.get(cache_key)
+
+    def _store(self, invoices: AnalyzeResult, pages: list[int], cache_key: Union[str, None]) -> AnalyzeResult:
+        """Map page numbers of the subset back to the original document, then cache the result."""
+
+        _remap_page_numbers(invoices, {idx + 1: page_num for idx, page_num in enumerate(pages)})
+        if self.cache:
+            self.cache.put(cache_key, invoices)
         return invoices
 
+    def analyze_invoice_pages(self, document_bytes: bytes, pages: list[int]) -> dict[int, list[Invoice]]:
+        """Analyze all requested pages in a single request and map the
+        returned invoices back to their source pages.
+        Args:
+            document_bytes (bytes): The document content in bytes.
+            pages (list[int]): List of page numbers to analyze.
+        Returns:
+            dict[int, list[Invoice]]: Page number mapped to the invoices that start on that page.
+        """
+
+        if not pages:
+            return {}
+        return self._invoices_by_page(self.analyze_document(document_bytes, pages=pages), pages)
+
+    async def analyze_invoice_pages_async(self, document_bytes: bytes, pages: list[int]) -> dict[int, list[Invoice]]:
+        """Async counterpart of analyze_invoice_pages."""
+
+        if not pages:
+            return {}
+        return self._invoices_by_page(await self.analyze_document_async(document_bytes, pages=pages), pages)
+
+    def _invoices_by_page(self, invoices: AnalyzeResult, pages: list[int]) -> dict[int, list[Invoice]]:
+        """Normalize the analyzed invoices and group them by the page they start on.
+        Args:
+            invoices (AnalyzeResult): The analysis result object.
+            pages (list[int]): The page numbers that were analyzed.
+        Returns:
+            dict[int, list[Invoice]]: Page number mapped to the invoices that start on that page.
+        """
+
+        invoices_by_page = {page_num: [] for page_num in pages}
+        normalized = []
+        for document in invoices.documents or []:
+            # An invoice spanning several pages is attributed to its first page
+            region_pages = [region.page_number for region in document.bounding_regions or []]
+            invoice = normalize_invoice(document, min(region_pages) if region_pages else min(pages))
+            invoices_by_page.setdefault(invoice.page_num, []).append(invoice)
+            normalized.append(invoice)
+        self.log_output(normalized)
+        return invoices_by_page
+
+
 if __name__ == "__main__":
     pass
     # DocumentIntelligenceService().analyze_document("453-DB6000582615.pdf", pages=[1,2,3,4])
@@ -0,0 +1,301 @@
+import os
+import re
+import json
+import hashlib
+import sqlite3
+import threading
+from dataclasses import replace
+from typing import Union
+from invoice_model import Invoice
+
+# The hash is split into bands stored in indexed columns. Two hashes within
+# max_distance < HASH_BANDS bits of each other share at least one band exactly,
+# so candidates are found with an index lookup instead of a full scan
+HASH_BANDS = 8
+
+# Pages beyond max_entries are evicted once every this many inserts
+EVICTION_INTERVAL = 1000
+
+
+def text_digest(text: str) -> str:
+    """ Return a digest of a page's text layer, ignoring whitespace, or "" if there is no text.
+    Args:
+        text (str): The text layer of the page.
+    Returns:
+        str: The hex digest of the normalized text.
+    """
+
+    normalized = re.sub(r"\s+", " ", text or "").strip().lower()
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest() if normalized else ""
+
+
+def page_signature(image: dict) -> dict:
+    """ Return the signature used to match copies of a rendered page.
+    Args:
+        image (dict): A page dictionary as returned by iter_pdf_pages.
+    Returns:
+        dict: The perceptual hash, the text digest and a content digest, which is
+              the text digest or, for pages without text, a digest of the image.
+    """
+
+    digest = text_digest(image.get("text", ""))
+    return {
+        "phash": image["phash"],
+        "text_digest": digest,
+        "content_digest": digest or hashlib.sha1(image["bytes"]).hexdigest()
+    }
+
+
+def hash_distance(first: str, second: str) -> int:
+    """ Return the number of differing bits between two hex encoded perceptual hashes. """
+
+    return (int(first, 16) ^ int(second, 16)).bit_count()
+
+
+def is_near_duplicate(first: dict, second: dict, max_distance: int) -> bool:
+    """ Decide whether two pages look like copies of each other.
+    The rendered images must be within max_distance bits, and when both pages
+    have a text layer the texts must match too.
+    Args:
+        first (dict): A page signature from page_signature.
+        second (dict): Another page signature.
+        max_distance (int): Maximum number of differing hash bits.
+    Returns:
+        bool: True if the pages are near-duplicates.
+    """
+
+    if first["text_digest"] and second["text_digest"] and first["text_digest"] != second["text_digest"]:
+        return False
+    return hash_distance(first["phash"], second["phash"]) <= max_distance
+
+
+def is_exact_duplicate(first: dict, second: dict) -> bool:
+    """ Decide whether two pages carry the same content.
+    A perceptual hash cannot tell two invoices on the same template apart when
+    only a few digits differ, so extracted data is only reused between pages
+    with the same text layer, or the same rendered image for scanned pages.
+    Args:
+        first (dict): A page signature from page_signature.
+        second (dict): Another page signature.
+    Returns:
+        bool: True if the pages have identical content.
+    """
+
+    return first["content_digest"] == second["content_digest"]
+
+
+def document_version(path: str) -> str:
+    """ Return the size and modification time identifying the current version of a file. """
+
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _bands(phash: str) -> list[int]:
+    width = len(phash) // HASH_BANDS
+    return [int(phash[band * width:(band + 1) * width], 16) for band in range(HASH_BANDS)]
+
+
+class DuplicatePageIndex:
+    """ Perceptual-hash index of classified pages across documents.
+    Each page is stored with its signature and verdict, and the invoices
+    extracted from it once known, so later near-duplicates can reuse the
+    verdict and exact copies can also reuse the extraction. Pages are
+    recorded with the version of their file, and a file's pages are
+    dropped when it changes, see start_document.
+    """
+
+    def __init__(self, db_path: str = None, max_distance: int = 4, max_entries: int = 100000):
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.hits = 0
+        self._inserts = 0
+        self._lock = threading.Lock()
+        # Without a path the index lives in memory and only spans this process
+        self._conn = sqlite3.connect(db_path or ":memory:", timeout=30, check_same_thread=False)
+        if db_path:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        band_columns = ", ".join(f"band{band} INTEGER NOT NULL" for band in range(HASH_BANDS))
+        self._conn.execute(
+            f"""CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                document TEXT NOT NULL,
+                version TEXT NOT NULL DEFAULT '',
+                page_num INTEGER NOT NULL,
+                phash TEXT NOT NULL,
+                text_digest TEXT NOT NULL,
+                content_digest TEXT NOT NULL,
+                is_invoice INTEGER NOT NULL,
+                invoices TEXT,
+                {band_columns},
+                UNIQUE (document, page_num)
+            )""")
+        # Indexes created before versions were recorded; their pages are dropped on the next run of each file
+        if "version" not in {row[1] for row in self._conn.execute("PRAGMA table_info(pages)")}:
+            self._conn.execute("ALTER TABLE pages ADD COLUMN version TEXT NOT NULL DEFAULT ''")
+        for band in range(HASH_BANDS):
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS pages_band{band} ON pages (band{band})")
+        self._conn.commit()
+
+    def start_document(self, document: str, version: str) -> None:
+        """ Drop the pages recorded for an earlier version of a document,
+        so a changed file never matches, or is copied from, its old content.
+        Args:
+            document (str): The document about to be classified.
+            version (str): Its current version from document_version.
+        """
+
+        with self._lock:
+            self._conn.execute("DELETE FROM pages WHERE document = ? AND version != ?", (document, version))
+            self._conn.commit()
+
+    def find(self, document: str, page_num: int, signature: dict) -> Union[dict, None]:
+        """ Return the closest copy of a page recorded earlier, if any.
+        Args:
+            document (str): The document the page belongs to.
+            page_num (int): The page number, so a page never matches itself.
+            signature (dict): The page signature from page_signature.
+        Returns:
+            Union[dict, None]: The matching page's document, page_num, is_invoice,
+                               whether it is an exact copy and its invoices
+                               (None until extracted), or None.
+        """
+
+        columns = "document, page_num, phash, text_digest, content_digest, is_invoice, invoices"
+        with self._lock:
+            if self.max_distance < HASH_BANDS:
+                condition = " OR ".join(f"band{band} = ?" for band in range(HASH_BANDS))
+                rows = self._conn.execute(
+                    f"SELECT {columns} FROM pages WHERE {condition}", _bands(signature["phash"])).fetchall()
+            else:
+                rows = self._conn.execute(f"SELECT {columns} FROM pages").fetchall()
+
+        best = None
+        for row in rows:
+            if row[0] == document and row[1] == page_num:
+                continue
+            candidate = {"phash": row[2], "text_digest": row[3], "content_digest": row[4]}
+            if not is_near_duplicate(signature, candidate, self.max_distance):
+                continue
+            # Prefer exact copies, then the closest hash
+            rank = (not is_exact_duplicate(signature, candidate), hash_distance(signature["phash"], row[2]))
+            if best is None or rank < best[0]:
+                best = (rank, row)
+        if best is None:
+            return None
+        self.hits += 1
+        rank, row = best
+        return {
+            "document": row[0],
+            "page_num": row[1],
+            "is_invoice": bool(row[5]),
+            "exact": not rank[0],
+            "invoices": json.loads(row[6]) if row[6] is not None else None
+        }
+
+    def add(self, document: str, version: str, page_num: int, signature: dict, is_invoice: bool) -> None:
+        """ Record a classified page. Every EVICTION_INTERVAL inserts, the oldest
+        pages beyond the size limit are evicted.
+        Args:
+            document (str): The document the page belongs to.
+            version (str): The document version from document_version.
+            page_num (int): The page number.
+            signature (dict): The page signature from page_signature.
+            is_invoice (bool): The classification verdict.
+        """
+
+        with self._lock:
+            self._conn.execute(
+                f"""INSERT OR REPLACE INTO pages
+                    (document, version, page_num, phash, text_digest, content_digest, is_invoice,
+                     {", ".join(f"band{band}" for band in range(HASH_BANDS))})
+                    VALUES (?, ?, ?, ?, ?, ?, ?, {", ".join("?" * HASH_BANDS)})""",
+                (document, version, page_num, signature["phash"], signature["text_digest"],
+                 signature["content_digest"], int(is_invoice), *_bands(signature["phash"])))
+            self._inserts += 1
+            if self._inserts % EVICTION_INTERVAL == 0:
+                self._conn.execute(
+                    """DELETE FROM pages WHERE id IN (
+                        SELECT id FROM pages ORDER BY id DESC LIMIT -1 OFFSET ?
+                    )""", (self.max_entries,))
+            self._conn.commit()
+
+    def set_invoices(self, document: str, page_num: int, invoices: list[dict]) -> None:
+        """ Store the invoices extracted from a page, for reuse by its copies.
+        Args:
+            document (str): The document the page belongs to.
+            page_num (int): The page number.
+            invoices (list[dict]): The extracted invoices, as Invoice.to_dict() dictionaries.
+        """
+
+        with self._lock:
+            self._conn.execute(
+                "UPDATE pages SET invoices = ? WHERE document = ? AND page_num = ?",
+                (json.dumps(invoices), document, page_num))
+            self._conn.commit()
+
+    def get_invoices(self, document: str, page_num: int) -> Union[list[dict], None]:
+        """ Return the invoices extracted from a page, or None if it was not extracted. """
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT invoices FROM pages WHERE document = ? AND page_num = ?", (document, page_num)).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def stats(self) -> dict:
+        """ Return the number of duplicate hits and indexed pages. """
+
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        return {"hits": self.hits, "entries": entries}
+
+
+def plan_extraction(pages: list[dict], document: str, index: Union[DuplicatePageIndex, None],
+                    invoice_pages: set = None) -> tuple[list[int], dict[int, list[Invoice]], dict[int, int]]:
+    """ Decide which invoice pages need a Document Intelligence request.
+    Exact copies of a page in another document reuse the invoices stored in
+    the index; exact copies within the document reuse their original's
+    invoices once it is extracted (see copy_invoices).
+    Args:
+        pages (list[dict]): Classified pages of the document.
+        document (str): The absolute path of the document.
+        index (DuplicatePageIndex): The duplicate page index, if enabled.
+        invoice_pages (set): All invoice pages of the document known so far.
+                             Defaults to the invoice pages among pages.
+    Returns:
+        tuple: The pages to extract, the invoices reused from other documents
+               by page number, and the same-document copies mapped to their original page.
+    """
+
+    if invoice_pages is None:
+        invoice_pages = {page["page_num"] for page in pages if page["is_invoice"]}
+    to_extract, reused, copies = [], {}, {}
+    for page in pages:
+        page_num, original = page["page_num"], page.get("duplicate_of")
+        if not page["is_invoice"]:
+            continue
+        if original and original["exact"]:
+            if original["document"] == document and original["page_num"] in invoice_pages:
+                copies[page_num] = original["page_num"]
+                continue
+            invoices = index.get_invoices(original["document"], original["page_num"]) if index else None
+            if invoices is not None:
+                reused[page_num] = copy_invoices([Invoice.from_dict(invoice) for invoice in invoices], page_num)
+                continue
+        to_extract.append(page_num)
+    return to_extract, reused, copies
+
+
+def copy_invoices(invoices: list[Invoice], page_num: int) -> list[Invoice]:
+    """ Return copies of an original page's invoices attributed to a duplicate page.
+    Args:
+        invoices (list[Invoice]): The invoices extracted from the original page.
+        page_num (int): The page number of the duplicate.
+    Returns:
+        list[Invoice]: The invoices with their page number replaced.
+    """
+
+    return [replace(invoice, page_num=page_num) for invoice in invoices]
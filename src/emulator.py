@@ -0,0 +1,278 @@
+import re
+import json
+import time
+import uuid
+import math
+import base64
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from utils import get_pdf_page_count
+from simulated_results import simulated_invoice
+
+# Document Intelligence analyze and poll routes, with or without the /documentintelligence prefix
+ANALYZE_ROUTE = re.compile(r"^(?P<prefix>.*)/documentModels/(?P<model_id>[^/:]+):analyze$")
+RESULT_ROUTE = re.compile(r"^.*/documentModels/(?P<model_id>[^/:]+)/analyzeResults/(?P<result_id>[^/]+)$")
+
+# Seconds between sweeps of expired analyze operations
+OPERATION_SWEEP_INTERVAL = 10
+
+# Azure OpenAI chat completions route, both deployment-based and v1 style
+CHAT_ROUTE = re.compile(r"^.*/chat/completions$")
+
+
+def _retry_after(seconds: float) -> str:
+    """ Format a Retry-After header; the SDKs only accept whole seconds. """
+
+    return str(math.ceil(seconds))
+
+
+class EmulatorState:
+    """ Settings and in-flight analyze operations shared by the request handlers. """
+
+    def __init__(self, args: argparse.Namespace):
+        self.chat_latency = args.chat_latency
+        self.analyze_latency = args.analyze_latency
+        self.jitter = args.jitter
+        self.poll_after = args.poll_after
+        self.throttle_rate = args.throttle_rate
+        self.retry_after = args.retry_after
+        self.failure_rate = args.failure_rate
+        self.operation_ttl = args.operation_ttl
+        self.result_template = None
+        if args.result_template:
+            with open(args.result_template, encoding="utf-8") as f:
+                self.result_template = json.load(f)
+        self.operations = {}
+        self.next_sweep = 0.0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def add_operation(self, result_id: str, operation: dict) -> None:
+        """ Register an analyze operation, dropping those that were never
+        polled to completion within operation_ttl seconds of being ready. """
+
+        now = time.time()
+        with self.lock:
+            if now >= self.next_sweep:
+                expired = [key for key, value in self.operations.items()
+                           if value["ready_at"] + self.operation_ttl < now]
+                for key in expired:
+                    del self.operations[key]
+                self.next_sweep = now + OPERATION_SWEEP_INTERVAL
+            self.operations[result_id] = operation
+
+
+class EmulatorHandler(BaseHTTPRequestHandler):
+    """ Speaks enough of the Document Intelligence and Azure OpenAI REST
+    protocols for the real SDK clients to run against it.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def state(self) -> EmulatorState:
+        return self.server.state
+
+    def log_message(self, format: str, *args) -> None:
+        # Keep the console quiet under load; failures are reported through responses
+        pass
+
+    def _send_json(self, status: int, body: dict = None, headers: dict = None) -> None:
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("x-ms-request-id", str(uuid.uuid4()))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _inject_fault(self) -> bool:
+        """ Answer with a throttling or server error if one is due. Returns True if it did. """
+
+        with self.state.lock:
+            self.state.requests += 1
+        if random.random() < self.state.throttle_rate:
+            self._send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                            {"Retry-After": _retry_after(self.state.retry_after)})
+            return True
+        if random.random() < self.state.failure_rate:
+            self._send_json(503, {"error": {"code": "ServiceUnavailable", "message": "Injected failure."}})
+            return True
+        return False
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _delay(self, latency: float) -> float:
+        return max(0.0, latency + random.uniform(-self.state.jitter, self.state.jitter))
+
+    def do_POST(self) -> None:
+        path = urlsplit(self.path).path
+        analyze = ANALYZE_ROUTE.match(path)
+        if analyze:
+            self._begin_analyze(analyze.group("prefix"), analyze.group("model_id"))
+        elif CHAT_ROUTE.match(path):
+            self._chat_completion()
+        else:
+            self._send_json(404, {"error": {"code": "NotFound", "message": f"No route for {path}"}})
+
+    def do_GET(self) -> None:
+        result = RESULT_ROUTE.match(urlsplit(self.path).path)
+        if result:
+            self._poll_analyze(result.group("result_id"))
+        else:
+            self._send_json(404, {"error": {"code": "NotFound", "message": f"No route for {self.path}"}})
+
+    def _begin_analyze(self, prefix: str, model_id: str) -> None:
+        body = self._read_json()
+        if self._inject_fault():
+            return
+        try:
+            page_count = get_pdf_page_count(base64.b64decode(body["base64Source"]))
+            if page_count is None:
+                raise ValueError("The document is not a readable PDF.")
+        except Exception as e:
+            self._send_json(400, {"error": {"code": "InvalidRequest", "message": str(e)}})
+            return
+
+        result_id = str(uuid.uuid4())
+        self.state.add_operation(result_id, {
+            "model_id": model_id,
+            "page_count": page_count,
+            "created": time.time(),
+            "ready_at": time.time() + self._delay(self.state.analyze_latency)
+        })
+        query = urlsplit(self.path).query
+        operation_location = (f"http://{self.headers['Host']}{prefix}/documentModels/{model_id}"
+                              f"/analyzeResults/{result_id}?{query}")
+        self._send_json(202, None, {
+            "Operation-Location": operation_location,
+            "Retry-After": _retry_after(self.state.poll_after)
+        })
+
+    def _poll_analyze(self, result_id: str) -> None:
+        with self.state.lock:
+            operation = self.state.operations.get(result_id)
+        if operation is None:
+            self._send_json(404, {"error": {"code": "NotFound", "message": "Unknown analyze result."}})
+            return
+        if self._inject_fault():
+            return
+
+        created = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(operation["created"]))
+        if time.time() < operation["ready_at"]:
+            self._send_json(200, {"status": "running", "createdDateTime": created,
+                                  "lastUpdatedDateTime": created},
+                            {"Retry-After": _retry_after(self.state.poll_after)})
+            return
+
+        with self.state.lock:
+            self.state.operations.pop(result_id, None)
+        analyze_result = self.state.result_template or {
+            "apiVersion": "2024-11-30",
+            "modelId": operation["model_id"],
+            "content": "",
+            "pages": [{"pageNumber": page_num, "spans": []}
+                      for page_num in range(1, operation["page_count"] + 1)],
+            "documents": [simulated_invoice(page_num)
+                          for page_num in range(1, operation["page_count"] + 1)]
+        }
+        self._send_json(200, {
+            "status": "succeeded",
+            "createdDateTime": created,
+            "lastUpdatedDateTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "analyzeResult": analyze_result
+        })
+
+    def _chat_completion(self) -> None:
+        body = self._read_json()
+        if self._inject_fault():
+            return
+
+        # Collect the text parts and the images of the conversation
+        texts, images = [], []
+        for message in body.get("messages", []):
+            content = message.get("content")
+            if isinstance(content, str):
+                texts.append(content)
+                continue
+            for part in content or []:
+                if part.get("type") == "text":
+                    texts.append(part.get("text", ""))
+                elif part.get("type") == "image_url":
+                    images.append(part.get("image_url", {}).get("url", ""))
+
+        time.sleep(self._delay(self.state.chat_latency))
+
+        # Stable verdicts derived from the image content
+        verdicts = [hashlib.sha256(image.encode("utf-8")).digest()[0] % 2 == 0 for image in images] or [False]
+        page_labels = [int(match) for text in texts for match in re.findall(r"^\s*Page (\d+):", text)]
+        if page_labels:
+            answer = json.dumps([{"page": page, "is_invoice": verdict}
+                                 for page, verdict in zip(page_labels, verdicts)])
+        else:
+            answer = "Yes" if verdicts[0] else "No"
+
+        prompt_tokens = sum(len(text) // 4 for text in texts) + 85 * len(images)
+        completion_tokens = max(1, len(answer) // 4)
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4.1"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": answer},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local emulator for the Document Intelligence and Azure OpenAI endpoints.")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--chat-latency", type=float, default=0.5, help="Chat completion latency in seconds")
+    parser.add_argument("--analyze-latency", type=float, default=2.0, help="Analyze operation duration in seconds")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Latency jitter in seconds")
+    parser.add_argument("--poll-after", type=float, default=1,
+                        help="Retry-After returned while an analysis runs, rounded up to whole seconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probability of an HTTP 429 response")
+    parser.add_argument("--retry-after", type=float, default=1,
+                        help="Retry-After sent with HTTP 429 responses, rounded up to whole seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability of an HTTP 503 response")
+    parser.add_argument("--operation-ttl", type=float, default=300,
+                        help="Seconds a finished analysis stays pollable before it is dropped")
+    parser.add_argument("--result-template", help="JSON file with a canned analyzeResult to return")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), EmulatorHandler)
+    server.daemon_threads = True
+    server.state = EmulatorState(args)
+    print(f"Emulator listening on http://{args.host}:{args.port}")
+    print(f"  DOCUMENT_INTELLIGENCE_API_ENDPOINT=http://{args.host}:{args.port}/")
+    print(f"  AI_FOUNDRY_ENDPOINT=http://{args.host}:{args.port}/")
+    print("  AZURE_AUTH_MODE=key")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Union
+from utils import get_pdf_page_count
+
+# Default location of the on-disk folder index
+DEFAULT_FOLDER_INDEX_PATH = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), "..", ".cache", "folder_index.sqlite"))
+
+# Fewer changed files than this are counted in-process, as the pool start-up costs more
+PARALLEL_MIN_FILES = 32
+
+
+def _name_condition(name_filter: Union[str, None]) -> tuple[str, list]:
+    """ Build the SQL condition and parameters for a case-insensitive substring filter on file names. """
+
+    if not name_filter:
+        return "", []
+    escaped = name_filter.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return " AND name LIKE ? ESCAPE '\\'", [f"%{escaped}%"]
+
+
+class FolderIndex:
+    """ Persistent index of the files in a folder with their size and page count.
+    Files are keyed by path, size and modification time, so a scan only opens
+    the files that are new or changed since the previous scan.
+    """
+
+    def __init__(self, db_path: str = None, workers: int = None):
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.workers = workers or int(os.getenv("FOLDER_INDEX_WORKERS", "0")) or os.cpu_count() or 1
+        self._lock = threading.Lock()
+        # Without a path the index lives in memory and only spans this process
+        self._conn = sqlite3.connect(db_path or ":memory:", timeout=30, check_same_thread=False)
+        if db_path:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                folder TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                pages INTEGER
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS files_folder_name ON files (folder, name)")
+        self._conn.commit()
+
+    def scan(self, folder_path: str) -> dict:
+        """ Bring the index of a folder up to date, counting the pages of new and changed PDFs only.
+        Args:
+            folder_path (str): The folder to scan.
+        Returns:
+            dict: The number of files in the folder, and of files added or changed and removed.
+        """
+
+        folder = os.path.abspath(folder_path)
+        entries = {}
+        if os.path.isdir(folder):
+            with os.scandir(folder) as it:
+                for entry in it:
+                    # Files moved or deleted since the directory was listed are skipped
+                    try:
+                        if not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries[entry.path] = (entry.name, stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            known = {path: (size, mtime_ns) for path, size, mtime_ns in self._conn.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE folder = ?", (folder,))}
+        changed = [path for path, (_, size, mtime_ns) in entries.items() if known.get(path) != (size, mtime_ns)]
+        removed = [path for path in known if path not in entries]
+
+        pdf_paths = [path for path in changed if path.lower().endswith(".pdf")]
+        page_counts = dict(zip(pdf_paths, self._count_pages(pdf_paths)))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                [(path, folder, *entries[path], page_counts.get(path)) for path in changed])
+            self._conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+            self._conn.commit()
+        return {"files": len(entries), "changed": len(changed), "removed": len(removed)}
+
+    def _count_pages(self, pdf_paths: list[str]) -> list[Union[int, None]]:
+        """ Count the pages of the given PDFs, across a process pool when there are many.
+        The pool is spawned rather than forked, as the scan runs alongside other threads.
+        """
+
+        if self.workers <= 1 or len(pdf_paths) < PARALLEL_MIN_FILES:
+            return [get_pdf_page_count(path) for path in pdf_paths]
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            return list(executor.map(get_pdf_page_count, pdf_paths, chunksize=16))
+
+    def list(self, folder_path: str, offset: int = 0, limit: int = None, name_filter: str = None) -> list[dict]:
+        """ List the indexed files of a folder, ordered by name.
+        Args:
+            folder_path (str): The folder, as passed to scan.
+            offset (int): Number of files to skip.
+            limit (int): Maximum number of files to return, or all when None.
+            name_filter (str): Only files whose name contains this text, ignoring case.
+        Returns:
+            list: A list of dictionaries with the file name, size in KB and number of pages.
+        """
+
+        condition, params = _name_condition(name_filter)
+        with self._lock:
+            rows = self._conn.execute(
+                f"""SELECT name, size, pages FROM files WHERE folder = ?{condition}
+                    ORDER BY name LIMIT ? OFFSET ?""",
+                [os.path.abspath(folder_path), *params, -1 if limit is None else limit, offset]).fetchall()
+        return [{"Name": name, "Size (KB)": round(size / 1024, 2), "Pages": pages} for name, size, pages in rows]
+
+    def count(self, folder_path: str, name_filter: str = None) -> int:
+        """ Return the number of indexed files of a folder matching the filter. """
+
+        condition, params = _name_condition(name_filter)
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM files WHERE folder = ?{condition}",
+                [os.path.abspath(folder_path), *params]).fetchone()[0]
+
+
+def load_invoices(folder_path: str, index: FolderIndex = None, offset: int = 0, limit: int = None,
+                  name_filter: str = None) -> list:
+    """ Load invoice files from a folder and return a
+        list of dictionaries with file information.
+        Each dictionary contains the file name, size in KB,
+        number of pages (if applicable).
+        Only new or changed files are read, see FolderIndex.
+    Args:
+        folder_path (str): The path to the folder containing invoice files.
+        index (FolderIndex): The folder index. Defaults to the one at FOLDER_INDEX_PATH.
+        offset (int): Number of files to skip.
+        limit (int): Maximum number of files to return, or all when None.
+        name_filter (str): Only files whose name contains this text, ignoring case.
+    Returns:
+        list: A list of dictionaries with file information.
+    """
+
+    index = index or FolderIndex(os.getenv("FOLDER_INDEX_PATH", DEFAULT_FOLDER_INDEX_PATH) or None)
+    index.scan(folder_path)
+    return index.list(folder_path, offset, limit, name_filter)
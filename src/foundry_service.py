@@ -1,74 +1,444 @@
 import os
+import re
+import json
 import asyncio
+from typing import Callable, Union
 from agent_framework.azure import AzureOpenAIChatClient
-from azure.identity import DefaultAzureCredential
+from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from openai import AsyncAzureOpenAI
 from agent_framework import ChatMessage, TextContent, DataContent, Role
-from utils import pdf_to_images
+from utils import iter_pdf_pages
+from classification_cache import ClassificationCache
+from duplicate_index import (DuplicatePageIndex, document_version, page_signature, is_near_duplicate,
+                             is_exact_duplicate)
+from text_classifier import classify_page_text
+from rate_limiter import get_rate_limiter
+from metrics import metrics
 
 # from dotenv import load_dotenv
 # load_dotenv(override=True)
 
+CLASSIFICATION_PROMPT = """
+                                Analyze the attached image and classify it if it's an invoice or not. 
+                                Reply ONLY with 'Yes' if it is an invoice, 'No' otherwise.
+                                Do not include any other text in your response."""
+
+BATCH_CLASSIFICATION_PROMPT = """
+                                Analyze each attached image and classify it if it's an invoice or not.
+                                Each image is preceded by its page number.
+                                Reply ONLY with a JSON array with one object per page, for example:
+                                [{"page": 1, "is_invoice": true}, {"page": 2, "is_invoice": false}]
+                                Do not include any other text in your response."""
+
+# Default location of the on-disk classification cache
+DEFAULT_CACHE_PATH = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), "..", ".cache", "classification.sqlite"))
+
+# Default location of the cross-document duplicate page index
+DEFAULT_DUPLICATE_INDEX_PATH = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), "..", ".cache", "page_hashes.sqlite"))
+
+
 class FoundryService:
 
-    def __init__(self):
-        self.agent = AzureOpenAIChatClient(
-            credential=DefaultAzureCredential(),
-            endpoint=os.getenv("AI_FOUNDRY_ENDPOINT"),
-            #api_key=os.getenv("AI_FOUNDRY_API_KEY"), # The API key is not needed when using DefaultAzureCredential
-            deployment_name="gpt-4.1"
+    def __init__(self, max_concurrency: int = None, cache: ClassificationCache = None, agent=None,
+                 duplicate_index: DuplicatePageIndex = None):
+        self.deployment_name = "gpt-4.1"
+        # An agent can be injected, e.g. a simulated one for offline benchmarks
+        self.agent = agent or AzureOpenAIChatClient(
+            deployment_name=self.deployment_name,
+            async_client=self._create_openai_client()
         ).create_agent(
             instructions="You're a document analyzer.",
             name="DocumentAnalyzer"
         )
+        # Maximum number of pages classified concurrently
+        self.max_concurrency = max_concurrency or int(
+            os.getenv("CLASSIFICATION_MAX_CONCURRENCY", "8"))
+        # Shared scheduler enforcing the Azure OpenAI request and token budgets
+        self.rate_limiter = get_rate_limiter("AZURE_OPENAI")
+        # Number of pages sent to the model in one request; 1 disables batching
+        self.batch_size = max(1, int(os.getenv("CLASSIFICATION_BATCH_SIZE", "1")))
+        # Rendering profile used for the pages sent to the model
+        self.render_profile = os.getenv("CLASSIFICATION_RENDER_PROFILE", "classification")
+        # Decide obvious pages locally from their text layer before calling the model
+        self.local_preclassifier = os.getenv("LOCAL_PRECLASSIFIER", "true").lower() == "true"
+        # Cache of previous verdicts, disabled when CLASSIFICATION_CACHE_PATH is empty
+        cache_path = os.getenv("CLASSIFICATION_CACHE_PATH", DEFAULT_CACHE_PATH)
+        self.cache = cache or (ClassificationCache(
+            cache_path,
+            max_entries=int(os.getenv("CLASSIFICATION_CACHE_MAX_ENTRIES", "10000"))
+        ) if cache_path else None)
+        # Reuse verdicts of near-duplicate pages, within documents and across them
+        # through DUPLICATE_INDEX_PATH; DUPLICATE_DETECTION=false disables it
+        self.duplicate_index = duplicate_index
+        if duplicate_index is None and os.getenv("DUPLICATE_DETECTION", "true").lower() == "true":
+            self.duplicate_index = DuplicatePageIndex(
+                os.getenv("DUPLICATE_INDEX_PATH", DEFAULT_DUPLICATE_INDEX_PATH),
+                max_distance=int(os.getenv("DUPLICATE_MAX_DISTANCE", "4")))
+
+    @staticmethod
+    def _create_openai_client() -> AsyncAzureOpenAI:
+        """Create the Azure OpenAI client used by the agent.
+        The client's own retries are turned off, so every throttled request
+        reaches the shared rate limiter, which retries it and adapts the concurrency.
+        Returns:
+            AsyncAzureOpenAI: The client.
+        """
+
+        # Set AZURE_AUTH_MODE=key to use the API key, e.g. against the local emulator
+        if os.getenv("AZURE_AUTH_MODE", "aad").lower() == "key":
+            auth = {"api_key": os.getenv("AI_FOUNDRY_API_KEY")}
+        else:
+            # The API key is not needed when using DefaultAzureCredential
+            auth = {"azure_ad_token_provider": get_bearer_token_provider(
+                DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default")}
+        return AsyncAzureOpenAI(
+            azure_endpoint=os.getenv("AI_FOUNDRY_ENDPOINT"),
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-10-21"),
+            max_retries=0,
+            **auth
+        )
+
+    def _page_result(self, image: dict, is_invoice: bool, input_tokens: int, output_tokens: int,
+                     decided_by: str, duplicate_of: dict = None) -> dict:
+        """Build the result dictionary for a classified page.
+        Args:
+            image (dict): A page dictionary as returned by iter_pdf_pages.
+            is_invoice (bool): The classification verdict.
+            input_tokens (int): Input tokens used to classify the page.
+            output_tokens (int): Output tokens used to classify the page.
+            decided_by (str): The stage that decided the page: "local", "cache", "duplicate" or "llm".
+            duplicate_of (dict): The document, page number and exactness of the page this one copies.
+        Returns:
+            dict: A dictionary containing page number, invoice status, media type, payload size and token usage.
+        """
+
+        return {
+            "page_num": image["page_num"],
+            "is_invoice": is_invoice,
+            "media_type": image["media_type"],
+            "payload_bytes": image["payload_bytes"],
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "decided_by": decided_by,
+            "duplicate_of": duplicate_of
+        }
+
+    def _classify_locally(self, image: dict) -> Union[dict, None]:
+        """Classify a page without a model call, if possible.
+        Obvious pages are decided by the local text-layer classifier,
+        then previously classified pages are served from the cache.
+        Args:
+            image (dict): A page dictionary as returned by iter_pdf_pages.
+        Returns:
+            Union[dict, None]: The page result, or None if the page needs the model.
+        """
+
+        # Decide obvious digital, blank and cover pages without a model call
+        if self.local_preclassifier:
+            local_result = classify_page_text(image.get("text", ""), image.get("has_graphics", True))
+            if local_result is not None:
+                return self._page_result(image, local_result, 0, 0, "local")
+
+        # Reuse a previous verdict for the same page, prompt and deployment.
+        # No tokens are spent on this run, so none are reported
+        if self.cache:
+            cached = self.cache.get(self._cache_key(image))
+            if cached:
+                return self._page_result(image, cached["is_invoice"], 0, 0, "cache")
+        return None
+
+    def _cache_key(self, image: dict) -> str:
+        """Return the classification cache key of a page."""
+
+        return ClassificationCache.make_key(image["bytes"], CLASSIFICATION_PROMPT, self.deployment_name)
+
+    async def _run_agent(self, message: ChatMessage):
+        """Send one message to the agent, timing only the model call itself,
+        not the wait for a rate limiter slot or the backoff between retries."""
+
+        with metrics.span("classify"):
+            return await self.agent.run(messages=message)
+
+    async def _classify_with_model(self, image: dict) -> dict:
+        """Classify a single page with the model.
+        Args:
+            image (dict): A page dictionary as returned by iter_pdf_pages.
+        Returns:
+            dict: The page result.
+        """
+
+        message = ChatMessage(
+            role=Role.USER,
+            contents=[
+                TextContent(text=CLASSIFICATION_PROMPT),
+                DataContent(
+                    data=image["bytes"],
+                    media_type=image["media_type"]
+                )
+            ]
+        )
+
+        # Send message to agent and receive response
+        response = await self.rate_limiter.run_async(lambda: self._run_agent(message), usage=_total_tokens)
+        _record_request(response, image["payload_bytes"])
+
+        # Process response
+        result = True if response.text.lower().startswith("yes") else False
+
+        if self.cache:
+            self.cache.put(
+                self._cache_key(image), result,
+                response.usage_details.input_token_count,
+                response.usage_details.output_token_count)
+
+        return self._page_result(
+            image, result,
+            response.usage_details.input_token_count,
+            response.usage_details.output_token_count,
+            "llm")
+
+    async def _classify_batch_with_model(self, images: list) -> list:
+        """Classify several pages with a single model request.
+        The model answers with a JSON array of verdicts keyed by page number.
+        If the response cannot be parsed, the pages are classified one by one, sequentially.
+        Args:
+            images (list): Page dictionaries as returned by iter_pdf_pages.
+        Returns:
+            list: The page results, in the same order as the images.
+        """
+
+        if len(images) == 1:
+            return [await self._classify_with_model(images[0])]
 
-    def pre_process_pdf(self, pdf_file_path: str) -> list:
+        contents = [TextContent(text=BATCH_CLASSIFICATION_PROMPT)]
+        for image in images:
+            contents.append(TextContent(text=f"Page {image['page_num']}:"))
+            contents.append(DataContent(data=image["bytes"], media_type=image["media_type"]))
+
+        message = ChatMessage(role=Role.USER, contents=contents)
+        response = await self.rate_limiter.run_async(lambda: self._run_agent(message), usage=_total_tokens)
+        _record_request(response, sum(image["payload_bytes"] for image in images))
+
+        verdicts = _parse_batch_verdicts(response.text, [image["page_num"] for image in images])
+        if verdicts is None:
+            # Fall back to one request per page, one after the other, so the
+            # batch still holds a single request slot of max_concurrency
+            return [await self._classify_with_model(image) for image in images]
+
+        # Split token usage back out per page: input tokens by image payload
+        # size, output tokens evenly; remainders go to the last page
+        input_shares = _split_tokens(
+            response.usage_details.input_token_count or 0, [image["payload_bytes"] for image in images])
+        output_shares = _split_tokens(
+            response.usage_details.output_token_count or 0, [1] * len(images))
+
+        results = []
+        for image, input_tokens, output_tokens in zip(images, input_shares, output_shares):
+            result = verdicts[image["page_num"]]
+            if self.cache:
+                self.cache.put(self._cache_key(image), result, input_tokens, output_tokens)
+            results.append(self._page_result(image, result, input_tokens, output_tokens, "llm"))
+        return results
+
+    async def classify_page(self, image: dict) -> dict:
+        """Classify a single rendered page as invoice or not.
+        Pages are decided by the first stage that is confident: the local
+        text-layer classifier, the classification cache, then the model.
+        Args:
+            image (dict): A page dictionary as returned by iter_pdf_pages.
+        Returns:
+            dict: A dictionary containing page number, invoice status, media type, payload size and token usage.
+        """
+
+        return self._classify_locally(image) or await self._classify_with_model(image)
+
+    async def pre_process_pdf_async(self, pdf_file_path: str, max_concurrency: int = None,
+                                    render_profile: str = None, batch_size: int = None,
+                                    known_results: dict = None, on_page: Callable[[dict], None] = None) -> list:
+        """Pre-process a PDF file concurrently to determine if each page is an invoice.
+        Args:
+            pdf_file_path (str): The path to the PDF file.
+            max_concurrency (int): Maximum number of model requests in flight.
+                                   Defaults to the service setting.
+            render_profile (str): Rendering profile name. Defaults to the service setting.
+            batch_size (int): Pages per model request. Defaults to the service setting.
+            known_results (dict): Page number mapped to a result from a previous run;
+                                  these pages are neither rendered nor classified again.
+            on_page (Callable[[dict], None]): Called with each new page result as soon as it is decided.
+        Returns:
+            list: A list of dictionaries ordered by page number, as returned by classify_page.
+        """
+
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrency)
+        batch_size = batch_size or self.batch_size
+        known_results = known_results or {}
+        document = os.path.abspath(pdf_file_path)
+        # Signatures and pending verdicts of this document's pages, for duplicate detection
+        signatures, verdicts = {}, {}
+        if self.duplicate_index:
+            version = document_version(document)
+            self.duplicate_index.start_document(document, version)
+
+        def report(results: list) -> list:
+            for result in results:
+                page_num = result["page_num"]
+                if page_num in verdicts and not verdicts[page_num].done():
+                    verdicts[page_num].set_result(result)
+                if self.duplicate_index and not result["duplicate_of"]:
+                    self.duplicate_index.add(
+                        document, version, page_num, signatures[page_num], result["is_invoice"])
+                if on_page:
+                    on_page(result)
+            return results
+
+        async def classify(batch: list) -> list:
+            try:
+                return report(await self._classify_batch_with_model(batch))
+            except Exception as e:
+                # Copies of these pages wait for their verdicts
+                for image in batch:
+                    if not verdicts[image["page_num"]].done():
+                        verdicts[image["page_num"]].set_exception(e)
+                raise
+            finally:
+                semaphore.release()
+
+        async def copy_verdict(image: dict, original: dict) -> list:
+            if "is_invoice" not in original:
+                original = {**original, "is_invoice": (await verdicts[original["page_num"]])["is_invoice"]}
+            return report([self._page_result(
+                image, original["is_invoice"], 0, 0, "duplicate",
+                {"document": original["document"], "page_num": original["page_num"], "exact": original["exact"]})])
+
+        # Render pages lazily in a worker thread. A request slot is claimed before
+        # a new batch is started, so rendering waits while all slots are busy and
+        # at most max_concurrency * batch_size pages are held in memory
+        images = iter_pdf_pages(pdf_file_path, render_profile or self.render_profile,
+                                skip_pages=set(known_results))
+        decided, tasks, batch = list(known_results.values()), [], []
+        while True:
+            image = await asyncio.to_thread(next, images, None)
+            if image is None:
+                break
+            if self.duplicate_index:
+                signatures[image["page_num"]] = page_signature(image)
+            local_result = self._classify_locally(image)
+            if local_result:
+                decided.extend(report([local_result]))
+                continue
+            original = self._find_duplicate(document, image["page_num"], signatures, verdicts)
+            if original:
+                tasks.append(asyncio.create_task(copy_verdict(image, original)))
+                continue
+            verdicts[image["page_num"]] = asyncio.get_running_loop().create_future()
+            if not batch:
+                await semaphore.acquire()
+            batch.append(image)
+            if len(batch) == batch_size:
+                tasks.append(asyncio.create_task(classify(batch)))
+                batch = []
+        if batch:
+            tasks.append(asyncio.create_task(classify(batch)))
+
+        for batch_results in await asyncio.gather(*tasks):
+            decided.extend(batch_results)
+        return sorted(decided, key=lambda page: page["page_num"])
+
+    def _find_duplicate(self, document: str, page_num: int, signatures: dict,
+                        verdicts: dict) -> Union[dict, None]:
+        """Find an earlier copy of a page, in the same document first, then in the duplicate index.
+        Args:
+            document (str): The absolute path of the document.
+            page_num (int): The page to look up.
+            signatures (dict): Page number mapped to the signatures of this document's pages.
+            verdicts (dict): Page number mapped to the pending verdicts of pages sent to the model.
+        Returns:
+            Union[dict, None]: The original's document, page_num and exactness, plus its
+                               is_invoice verdict when already known, or None.
+        """
+
+        if not self.duplicate_index:
+            return None
+        signature = signatures[page_num]
+
+        # Pages of this document still waiting for the model are matched here
+        matches = [(not is_exact_duplicate(signature, other), other_page)
+                   for other_page, other in signatures.items()
+                   if other_page in verdicts and other_page != page_num
+                   and is_near_duplicate(signature, other, self.duplicate_index.max_distance)]
+        if matches:
+            inexact, other_page = min(matches)
+            return {"document": document, "page_num": other_page, "exact": not inexact}
+
+        original = self.duplicate_index.find(document, page_num, signature)
+        if original:
+            return {key: original[key] for key in ("document", "page_num", "exact", "is_invoice")}
+        return None
+
+    def pre_process_pdf(self, pdf_file_path: str, max_concurrency: int = None, render_profile: str = None,
+                        batch_size: int = None) -> list:
         """Pre-process a PDF file to determine if each page is an invoice.
         Args:
             pdf_file_path (str): The path to the PDF file.
+            max_concurrency (int): Maximum number of model requests in flight.
+            render_profile (str): Rendering profile name for the classified pages.
+            batch_size (int): Pages per model request.
             Returns:
-            list: A list of dictionaries containing page number, invoice status, image in base64, and token usage.
+            list: A list of dictionaries containing page number, invoice status, media type, payload size and token usage.
         """
-        
-        # Convert PDF to images
-        images = pdf_to_images(pdf_file_path)
 
-        pre_process_result = []
-        # Process each image
-        for image in images:
-            message = ChatMessage(
-                role=Role.USER,
-                contents=[
-                    TextContent(text="""
-                                Analyze the attached image and classify it if it's an invoice or not. 
-                                Reply ONLY with 'Yes' if it is an invoice, 'No' otherwise.
-                                Do not include any other text in your response."""),
-                    DataContent(
-                        data=image["bytes"],
-                        media_type="image/png"
-                    )
-                ]
-            )
+        return asyncio.run(self.pre_process_pdf_async(pdf_file_path, max_concurrency, render_profile, batch_size))
+
+
+def _parse_batch_verdicts(text: str, page_nums: list[int]) -> Union[dict[int, bool], None]:
+    """Parse a batch classification response.
+    Args:
+        text (str): The model response, a JSON array possibly wrapped in a code fence.
+        page_nums (list[int]): The page numbers that were sent.
+    Returns:
+        Union[dict[int, bool], None]: Page number mapped to invoice status,
+                                      or None if any page is missing or malformed.
+    """
+
+    match = re.search(r"\[.*\]", text or "", re.DOTALL)
+    if not match:
+        return None
+    try:
+        items = json.loads(match.group(0))
+        verdicts = {int(item["page"]): item["is_invoice"] for item in items}
+    except (ValueError, TypeError, KeyError):
+        return None
+    if any(not isinstance(verdicts.get(page_num), bool) for page_num in page_nums):
+        return None
+    return {page_num: verdicts[page_num] for page_num in page_nums}
+
+
+def _record_request(response, payload_bytes: int) -> None:
+    """Record the bytes sent and tokens used by a classification request."""
+
+    metrics.increment("bytes_sent", payload_bytes, target="azure_openai")
+    metrics.increment("tokens", response.usage_details.input_token_count or 0, direction="input")
+    metrics.increment("tokens", response.usage_details.output_token_count or 0, direction="output")
+
+
+def _total_tokens(response) -> int:
+    """Return the total tokens used by an agent response."""
 
-            # Send message to agent and receive response
-            response = asyncio.run(self.agent.run(messages=message))
+    return (response.usage_details.input_token_count or 0) + (response.usage_details.output_token_count or 0)
 
-            # Process response
-            result = True if response.text.lower().startswith("yes") else False
 
-            # Append result to process_result list
-            pre_process_result.append({
-                "page_num": image["page_num"],
-                "is_invoice": result,
-                "image": image["base64"],
-                "input_tokens": response.usage_details.input_token_count,
-                "output_tokens": response.usage_details.output_token_count
-            })
+def _split_tokens(total: int, weights: list[int]) -> list[int]:
+    """Split a token count proportionally to weights, keeping the exact total."""
 
-        # Return the process result list
-        return pre_process_result
+    weight_sum = sum(weights) or len(weights)
+    shares = [total * (weight or 0) // weight_sum for weight in weights]
+    shares[-1] += total - sum(shares)
+    return shares
 
 
 if __name__ == "__main__":
     pass
     # FoundryService().pre_process_pdf("435-2086_Invoice_Repeated_in_2pages.pdf")
-    # byte_stream_images = pdf_to_images("453-2426288.pdf")
+    # byte_stream_images = list(iter_pdf_pages("453-2426288.pdf"))
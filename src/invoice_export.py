@@ -0,0 +1,262 @@
+import os
+import re
+import uuid
+import threading
+from datetime import date, datetime, timezone
+from typing import Union
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from invoice_model import Invoice
+
+# Columns every dataset is partitioned by, so reports can prune by vendor and month
+PARTITION_COLUMNS = ["vendor", "invoice_month"]
+
+INVOICE_SCHEMA = pa.schema([
+    ("document", pa.string()),
+    ("page_num", pa.int32()),
+    ("invoice_id", pa.string()),
+    ("vendor_name", pa.string()),
+    ("customer_name", pa.string()),
+    ("customer_id", pa.string()),
+    ("purchase_order", pa.string()),
+    ("invoice_date", pa.date32()),
+    ("due_date", pa.date32()),
+    ("service_start_date", pa.date32()),
+    ("service_end_date", pa.date32()),
+    ("currency", pa.string()),
+    ("sub_total", pa.float64()),
+    ("total_tax", pa.float64()),
+    ("previous_unpaid_balance", pa.float64()),
+    ("amount_due", pa.float64()),
+    ("invoice_total", pa.float64()),
+    ("item_count", pa.int32()),
+    ("confidence", pa.float64()),
+    ("exported_at", pa.timestamp("us", tz="UTC")),
+    ("vendor", pa.string()),
+    ("invoice_month", pa.string()),
+])
+
+LINE_ITEM_SCHEMA = pa.schema([
+    ("document", pa.string()),
+    ("page_num", pa.int32()),
+    ("invoice_id", pa.string()),
+    ("vendor_name", pa.string()),
+    ("invoice_date", pa.date32()),
+    ("line_number", pa.int32()),
+    ("description", pa.string()),
+    ("product_code", pa.string()),
+    ("quantity", pa.float64()),
+    ("unit", pa.string()),
+    ("unit_price", pa.float64()),
+    ("tax", pa.float64()),
+    ("amount", pa.float64()),
+    ("currency", pa.string()),
+    ("date", pa.date32()),
+    ("confidence", pa.float64()),
+    ("exported_at", pa.timestamp("us", tz="UTC")),
+    ("vendor", pa.string()),
+    ("invoice_month", pa.string()),
+])
+
+# One row per exported document, also for documents without invoices, so that
+# the latest export of a document supersedes its earlier ones
+EXPORT_SCHEMA = pa.schema([
+    ("document", pa.string()),
+    ("exported_at", pa.timestamp("us", tz="UTC")),
+    ("invoice_count", pa.int32()),
+])
+
+DATE_COLUMNS = {
+    "invoices": ["invoice_date", "due_date", "service_start_date", "service_end_date"],
+    "line_items": ["invoice_date", "date"],
+}
+
+
+def _value(amount: Union[dict, None], key: str = "value"):
+    """ Read a key of an optional amount dictionary. """
+
+    return amount.get(key) if amount else None
+
+
+def _partition_value(value: Union[str, None]) -> str:
+    """ Make a value safe to use as a directory name. """
+
+    value = re.sub(r"[^\w.-]+", "_", (value or "").strip()).strip("_")
+    return value[:64] or "unknown"
+
+
+class InvoiceExporter:
+    """ Appends extracted invoice headers and line items to partitioned
+    Parquet datasets. Rows are buffered and written in batches, each batch
+    as new files under <root>/invoices and <root>/line_items, partitioned
+    by vendor and invoice month. Every export of a document is also recorded
+    under <root>/exports, and read_export only returns the rows of each
+    document's latest export, so exporting a document again replaces its rows.
+    """
+
+    def __init__(self, root: str, batch_size: int = 1000):
+        self.root = root
+        self.batch_size = batch_size
+        self.exported = 0
+        self._invoices = []
+        self._line_items = []
+        self._exports = []
+        self._lock = threading.Lock()
+
+    def add(self, document: str, invoices: list[Union[Invoice, dict]]) -> None:
+        """ Buffer the invoices of a document, writing a batch once enough are buffered.
+        The document's rows from earlier exports are superseded, also when it now has no invoices.
+        Args:
+            document (str): The source document name, which identifies the document across exports.
+            invoices (list): Invoice objects, or their to_dict form as written to the JSONL output.
+        """
+
+        exported_at = datetime.now(timezone.utc)
+        with self._lock:
+            for invoice in invoices:
+                if not isinstance(invoice, dict):
+                    invoice = invoice.to_dict()
+                self._add_invoice(document, invoice, exported_at)
+            self._exports.append({"document": document, "exported_at": exported_at, "invoice_count": len(invoices)})
+            if len(self._invoices) >= self.batch_size:
+                self._flush()
+
+    def _add_invoice(self, document: str, invoice: dict, exported_at: datetime) -> None:
+        dates = invoice.get("dates") or {}
+        currency = next((_value(invoice.get(name), "currency")
+                         for name in ("invoice_total", "amount_due", "sub_total")
+                         if _value(invoice.get(name), "currency")), None)
+        common = {
+            "document": document,
+            "page_num": invoice["page_num"],
+            "invoice_id": invoice.get("invoice_id"),
+            "vendor_name": invoice.get("vendor_name"),
+            "invoice_date": dates.get("invoice_date"),
+            "exported_at": exported_at,
+            "vendor": _partition_value(invoice.get("vendor_name")),
+        }
+        self._invoices.append({
+            **common,
+            "customer_name": invoice.get("customer_name"),
+            "customer_id": invoice.get("customer_id"),
+            "purchase_order": invoice.get("purchase_order"),
+            "due_date": dates.get("due_date"),
+            "service_start_date": dates.get("service_start_date"),
+            "service_end_date": dates.get("service_end_date"),
+            "currency": currency,
+            "sub_total": _value(invoice.get("sub_total")),
+            "total_tax": _value(invoice.get("total_tax")),
+            "previous_unpaid_balance": _value(invoice.get("previous_unpaid_balance")),
+            "amount_due": _value(invoice.get("amount_due")),
+            "invoice_total": _value(invoice.get("invoice_total")),
+            "item_count": len(invoice.get("items") or []),
+            "confidence": invoice.get("confidence"),
+        })
+        for line_number, item in enumerate(invoice.get("items") or [], start=1):
+            self._line_items.append({
+                **common,
+                "line_number": line_number,
+                "description": item.get("description"),
+                "product_code": item.get("product_code"),
+                "quantity": item.get("quantity"),
+                "unit": item.get("unit"),
+                "unit_price": _value(item.get("unit_price")),
+                "tax": _value(item.get("tax")),
+                "amount": _value(item.get("amount")),
+                "currency": (_value(item.get("amount"), "currency")
+                             or _value(item.get("unit_price"), "currency") or currency),
+                "date": item.get("date_value"),
+                "confidence": item.get("confidence"),
+            })
+
+    def flush(self) -> None:
+        """ Write all buffered rows. """
+
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._exports:
+            return
+        batch_id = uuid.uuid4().hex
+        for name, rows, schema in (("invoices", self._invoices, INVOICE_SCHEMA),
+                                   ("line_items", self._line_items, LINE_ITEM_SCHEMA)):
+            if rows:
+                self._write(name, rows, schema, batch_id)
+        # Recorded last, so a document's earlier rows are only superseded once its new rows are written
+        ds.write_dataset(
+            pa.Table.from_pylist(self._exports, schema=EXPORT_SCHEMA), os.path.join(self.root, "exports"),
+            format="parquet", basename_template=f"part-{batch_id}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore")
+        self.exported += len(self._invoices)
+        self._invoices, self._line_items, self._exports = [], [], []
+
+    def _write(self, name: str, rows: list[dict], schema: pa.Schema, batch_id: str) -> None:
+        """ Convert a batch of rows to a typed Arrow table and append it to a dataset. """
+
+        df = pd.DataFrame(rows)
+        # Dates come from the service's ISO values, never from the printed text,
+        # whose day and month order depends on the invoice's locale
+        for column in DATE_COLUMNS[name]:
+            df[column] = pd.to_datetime(df[column], errors="coerce", format="ISO8601").dt.date
+        month = pd.to_datetime(df["invoice_date"], errors="coerce").dt.strftime("%Y-%m")
+        df["invoice_month"] = month.fillna("unknown")
+
+        table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+        ds.write_dataset(
+            table, os.path.join(self.root, name), format="parquet",
+            partitioning=PARTITION_COLUMNS, partitioning_flavor="hive",
+            basename_template=f"part-{batch_id}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore")
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self) -> "InvoiceExporter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def read_export(root: str, name: str = "invoices", vendor: str = None,
+                start: date = None, end: date = None) -> pd.DataFrame:
+    """ Load an exported dataset, reading only the partitions that match the filters.
+    Only the rows of each document's latest export are returned.
+    Args:
+        root (str): The export folder.
+        name (str): The dataset, "invoices" or "line_items".
+        vendor (str): Only rows of this vendor name.
+        start (date): Only invoices dated on or after this day.
+        end (date): Only invoices dated on or before this day.
+    Returns:
+        pd.DataFrame: The matching rows.
+    """
+
+    schema = INVOICE_SCHEMA if name == "invoices" else LINE_ITEM_SCHEMA
+    dataset = ds.dataset(os.path.join(root, name), schema=schema, format="parquet", partitioning="hive")
+    conditions = []
+    if vendor:
+        conditions.append(ds.field("vendor") == _partition_value(vendor))
+    # The month partitions prune whole directories, the dates filter within them
+    if start:
+        conditions.append(ds.field("invoice_month") >= f"{start:%Y-%m}")
+        conditions.append(ds.field("invoice_date") >= pa.scalar(start, pa.date32()))
+    if end:
+        conditions.append(ds.field("invoice_month") <= f"{end:%Y-%m}")
+        conditions.append(ds.field("invoice_date") <= pa.scalar(end, pa.date32()))
+    condition = None
+    for expression in conditions:
+        condition = expression if condition is None else condition & expression
+    df = dataset.to_table(filter=condition).to_pandas()
+
+    # Drop rows superseded by a later export of the same document. Rows written
+    # before exports were recorded are kept until their document is exported again
+    exports_path = os.path.join(root, "exports")
+    if os.path.isdir(exports_path):
+        exports = ds.dataset(exports_path, schema=EXPORT_SCHEMA, format="parquet").to_table(
+            columns=["document", "exported_at"]).to_pandas()
+        latest = df["document"].map(exports.groupby("document")["exported_at"].max())
+        df = df[latest.isna() | (df["exported_at"] == latest)].reset_index(drop=True)
+    return df
@@ -0,0 +1,215 @@
+from collections.abc import Mapping
+from dataclasses import asdict, dataclass, field
+from typing import Union
+
+
+@dataclass(slots=True)
+class Amount:
+    """ A monetary field with its parsed value and currency. """
+
+    content: Union[str, None] = None
+    value: Union[float, None] = None
+    currency: Union[str, None] = None
+    confidence: Union[float, None] = None
+
+    @classmethod
+    def from_dict(cls, data: Union[dict, None]) -> Union["Amount", None]:
+        return cls(**data) if data else None
+
+
+@dataclass(slots=True)
+class Address:
+    """ An address block and the recipient printed above it. """
+
+    content: Union[str, None] = None
+    recipient: Union[str, None] = None
+    confidence: Union[float, None] = None
+
+    @classmethod
+    def from_dict(cls, data: Union[dict, None]) -> Union["Address", None]:
+        return cls(**data) if data else None
+
+
+@dataclass(slots=True)
+class LineItem:
+    """ A single invoice line. """
+
+    description: Union[str, None] = None
+    quantity: Union[float, None] = None
+    unit: Union[str, None] = None
+    unit_price: Union[Amount, None] = None
+    product_code: Union[str, None] = None
+    date: Union[str, None] = None
+    # ISO 8601 value of the date, as parsed by the service
+    date_value: Union[str, None] = None
+    tax: Union[Amount, None] = None
+    amount: Union[Amount, None] = None
+    confidence: Union[float, None] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LineItem":
+        return cls(**{**data,
+                      "unit_price": Amount.from_dict(data.get("unit_price")),
+                      "tax": Amount.from_dict(data.get("tax")),
+                      "amount": Amount.from_dict(data.get("amount"))})
+
+
+@dataclass(slots=True)
+class Invoice:
+    """ An invoice extracted by the prebuilt-invoice model, normalized once
+    so that the UI, logging and export do not walk the raw fields again.
+    """
+
+    page_num: int
+    invoice_id: Union[str, None] = None
+    invoice_date: Union[str, None] = None
+    due_date: Union[str, None] = None
+    purchase_order: Union[str, None] = None
+    vendor_name: Union[str, None] = None
+    customer_name: Union[str, None] = None
+    customer_id: Union[str, None] = None
+    vendor_address: Union[Address, None] = None
+    customer_address: Union[Address, None] = None
+    billing_address: Union[Address, None] = None
+    shipping_address: Union[Address, None] = None
+    service_address: Union[Address, None] = None
+    remittance_address: Union[Address, None] = None
+    service_start_date: Union[str, None] = None
+    service_end_date: Union[str, None] = None
+    sub_total: Union[Amount, None] = None
+    total_tax: Union[Amount, None] = None
+    previous_unpaid_balance: Union[Amount, None] = None
+    amount_due: Union[Amount, None] = None
+    invoice_total: Union[Amount, None] = None
+    items: list[LineItem] = field(default_factory=list)
+    confidence: Union[float, None] = None
+    # Confidence of every header field, keyed by the service's field name
+    confidences: dict[str, float] = field(default_factory=dict)
+    # ISO 8601 value of every date field parsed by the service, keyed by attribute name
+    dates: dict[str, str] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        """ Return the invoice as a JSON-serializable dictionary. """
+
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Invoice":
+        """ Rebuild an invoice from the output of to_dict. """
+
+        values = dict(data)
+        for name in ADDRESS_FIELDS.values():
+            values[name] = Address.from_dict(data.get(name))
+        for name in AMOUNT_FIELDS.values():
+            values[name] = Amount.from_dict(data.get(name))
+        values["items"] = [LineItem.from_dict(item) for item in data.get("items") or []]
+        return cls(**values)
+
+
+# Service field names mapped to the attributes of the normalized model
+TEXT_FIELDS = {
+    "InvoiceId": "invoice_id",
+    "InvoiceDate": "invoice_date",
+    "DueDate": "due_date",
+    "PurchaseOrder": "purchase_order",
+    "VendorName": "vendor_name",
+    "CustomerName": "customer_name",
+    "CustomerId": "customer_id",
+    "ServiceStartDate": "service_start_date",
+    "ServiceEndDate": "service_end_date",
+}
+ADDRESS_FIELDS = {
+    "Vendor": "vendor_address",
+    "Customer": "customer_address",
+    "Billing": "billing_address",
+    "Shipping": "shipping_address",
+    "Service": "service_address",
+    "Remittance": "remittance_address",
+}
+AMOUNT_FIELDS = {
+    "SubTotal": "sub_total",
+    "TotalTax": "total_tax",
+    "PreviousUnpaidBalance": "previous_unpaid_balance",
+    "AmountDue": "amount_due",
+    "InvoiceTotal": "invoice_total",
+}
+
+
+def _amount(document_field: Union[Mapping, None]) -> Union[Amount, None]:
+    """ Parse a currency or number field into an Amount. """
+
+    if not document_field:
+        return None
+    currency = document_field.get("valueCurrency") or {}
+    value = currency.get("amount")
+    if value is None:
+        value = document_field.get("valueNumber")
+    return Amount(
+        content=document_field.get("content"),
+        value=float(value) if value is not None else None,
+        currency=currency.get("currencyCode"),
+        confidence=document_field.get("confidence"))
+
+
+def _line_item(item: Mapping) -> LineItem:
+    """ Normalize one entry of the Items field. """
+
+    values = item.get("valueObject") or {}
+
+    def content(name: str) -> Union[str, None]:
+        value = values.get(name)
+        return value.get("content") if value else None
+
+    date = values.get("Date")
+    date_value = date.get("valueDate") if date else None
+    quantity = values.get("Quantity")
+    quantity_value = quantity.get("valueNumber") if quantity else None
+    return LineItem(
+        description=content("Description"),
+        quantity=float(quantity_value) if quantity_value is not None else None,
+        unit=content("Unit"),
+        unit_price=_amount(values.get("UnitPrice")),
+        product_code=content("ProductCode"),
+        date=content("Date"),
+        date_value=str(date_value) if date_value else None,
+        tax=_amount(values.get("Tax")),
+        amount=_amount(values.get("Amount")),
+        confidence=item.get("confidence"))
+
+
+def normalize_invoice(document: Mapping, page_num: int = None) -> Invoice:
+    """ Convert an analyzed invoice document into an Invoice in a single pass over its fields.
+    Args:
+        document (Mapping): An AnalyzedDocument, or its JSON form, from the prebuilt-invoice model.
+        page_num (int): The page the invoice starts on. Defaults to its first bounding region.
+    Returns:
+        Invoice: The normalized invoice.
+    """
+
+    if page_num is None:
+        region_pages = [region.get("pageNumber") for region in document.get("boundingRegions") or []]
+        page_num = min(region_pages) if region_pages else 1
+
+    fields = document.get("fields") or {}
+    invoice = Invoice(page_num=page_num, confidence=document.get("confidence"))
+    for name, value in fields.items():
+        if value.get("confidence") is not None:
+            invoice.confidences[name] = value.get("confidence")
+        if name in TEXT_FIELDS:
+            setattr(invoice, TEXT_FIELDS[name], value.get("content"))
+            if value.get("valueDate"):
+                invoice.dates[TEXT_FIELDS[name]] = str(value.get("valueDate"))
+        elif name in AMOUNT_FIELDS:
+            setattr(invoice, AMOUNT_FIELDS[name], _amount(value))
+        elif name == "Items":
+            invoice.items = [_line_item(item) for item in value.get("valueArray") or []]
+
+    for prefix, attribute in ADDRESS_FIELDS.items():
+        address = fields.get(f"{prefix}Address")
+        recipient = fields.get(f"{prefix}AddressRecipient")
+        if address or recipient:
+            setattr(invoice, attribute, Address(
+                content=address.get("content") if address else None,
+                recipient=recipient.get("content") if recipient else None,
+                confidence=address.get("confidence") if address else None))
+    return invoice
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Union
+
+# Per-page stages, in pipeline order
+STAGES = ("classified", "extracted")
+
+
+class JobStore:
+    """ SQLite-backed ledger of document and page processing.
+    Documents are identified by their content hash, so a modified file is
+    processed again. Each page records which stages completed together with
+    their outputs, letting a restarted run skip finished work and retry only
+    what failed.
+    """
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        # The ledger may be shared by several worker processes
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """CREATE TABLE IF NOT EXISTS documents (
+                doc_id TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                record TEXT,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pages (
+                doc_id TEXT NOT NULL,
+                page_num INTEGER NOT NULL,
+                stage TEXT NOT NULL,
+                result TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (doc_id, page_num, stage)
+            );
+            CREATE TABLE IF NOT EXISTS leases (
+                path TEXT PRIMARY KEY,
+                worker_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                documents INTEGER NOT NULL,
+                pages INTEGER NOT NULL,
+                started REAL NOT NULL,
+                updated REAL NOT NULL
+            );""")
+        self._conn.commit()
+
+    @staticmethod
+    def document_id(pdf_path: str) -> str:
+        """ Return the content hash identifying a document.
+        Args:
+            pdf_path (str): The path to the PDF file.
+        Returns:
+            str: The SHA-256 hex digest of the file content.
+        """
+
+        digest = hashlib.sha256()
+        with open(pdf_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get_document(self, doc_id: str) -> Union[dict, None]:
+        """ Return the ledger entry of a document, or None if it is unknown.
+        Args:
+            doc_id (str): The document id from document_id.
+        Returns:
+            Union[dict, None]: The status, attempts, error and final record of the document.
+        """
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path, status, attempts, error, record FROM documents WHERE doc_id = ?",
+                (doc_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "path": row[0],
+            "status": row[1],
+            "attempts": row[2],
+            "error": row[3],
+            "record": json.loads(row[4]) if row[4] else None
+        }
+
+    def start_document(self, doc_id: str, path: str) -> None:
+        """ Mark a document as running and count the attempt. """
+
+        with self._lock:
+            self._conn.execute(
+                """INSERT INTO documents (doc_id, path, status, attempts, updated) VALUES (?, ?, 'running', 1, ?)
+                   ON CONFLICT(doc_id) DO UPDATE SET
+                       path = excluded.path, status = 'running', attempts = attempts + 1,
+                       error = NULL, updated = excluded.updated""",
+                (doc_id, path, time.time()))
+            self._conn.commit()
+
+    def finish_document(self, doc_id: str, record: dict) -> None:
+        """ Mark a document as done and store its final record. """
+
+        with self._lock:
+            self._conn.execute(
+                "UPDATE documents SET status = 'done', record = ?, updated = ? WHERE doc_id = ?",
+                (json.dumps(record), time.time(), doc_id))
+            self._conn.commit()
+
+    def fail_document(self, doc_id: str, error: str) -> None:
+        """ Mark a document as failed so the next run retries it. """
+
+        with self._lock:
+            self._conn.execute(
+                "UPDATE documents SET status = 'failed', error = ?, updated = ? WHERE doc_id = ?",
+                (error, time.time(), doc_id))
+            self._conn.commit()
+
+    def complete_page(self, doc_id: str, page_num: int, stage: str, result) -> None:
+        """ Record that a page finished a stage, with the stage output.
+        Args:
+            doc_id (str): The document id from document_id.
+            page_num (int): The 1-based page number.
+            stage (str): One of STAGES.
+            result: The JSON-serializable stage output.
+        """
+
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage '{stage}'. Available stages: {', '.join(STAGES)}")
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                (doc_id, page_num, stage, json.dumps(result), time.time()))
+            self._conn.commit()
+
+    def get_pages(self, doc_id: str, stage: str) -> dict:
+        """ Return the outputs of the pages that completed a stage.
+        Args:
+            doc_id (str): The document id from document_id.
+            stage (str): One of STAGES.
+        Returns:
+            dict: Page number mapped to the stored stage output.
+        """
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT page_num, result FROM pages WHERE doc_id = ? AND stage = ?",
+                (doc_id, stage)).fetchall()
+        return {page_num: json.loads(result) for page_num, result in rows}
+
+    def summary(self) -> dict:
+        """ Return the number of documents per status. """
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM documents GROUP BY status").fetchall()
+        return dict(rows)
+
+    def claim_document(self, path: str, worker_id: str, lease_seconds: float) -> bool:
+        """ Try to take an expiring lease on a document.
+        A document can be claimed when nobody holds it, when the previous
+        lease expired (e.g. its worker crashed or it failed), or when it was
+        done but the file changed since.
+        Args:
+            path (str): The path to the PDF file.
+            worker_id (str): The id of the claiming worker.
+            lease_seconds (float): How long the lease is valid without a heartbeat.
+        Returns:
+            bool: True if this worker now holds the lease, False also when the file is gone.
+        """
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                """INSERT INTO leases (path, worker_id, status, size, mtime, expires)
+                   VALUES (?, ?, 'leased', ?, ?, ?)
+                   ON CONFLICT(path) DO UPDATE SET
+                       worker_id = excluded.worker_id, status = 'leased', size = excluded.size,
+                       mtime = excluded.mtime, expires = excluded.expires
+                   WHERE (leases.status != 'done' AND leases.expires < ?)
+                      OR (leases.status = 'done' AND (leases.size != excluded.size OR leases.mtime != excluded.mtime))""",
+                (path, worker_id, stat.st_size, stat.st_mtime, now + lease_seconds, now))
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def renew_lease(self, path: str, worker_id: str, lease_seconds: float) -> bool:
+        """ Extend a lease held by this worker (heartbeat).
+        Returns:
+            bool: False if the lease was lost to another worker.
+        """
+
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE leases SET expires = ? WHERE path = ? AND worker_id = ? AND status = 'leased'",
+                (time.time() + lease_seconds, path, worker_id))
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def release_lease(self, path: str, worker_id: str, done: bool, retry_after: float = 0) -> None:
+        """ Release a lease, marking the document done or claimable again.
+        Args:
+            path (str): The path to the PDF file.
+            worker_id (str): The id of the worker holding the lease.
+            done (bool): Whether the document was processed successfully.
+            retry_after (float): Seconds before a failed document may be claimed again.
+        """
+
+        with self._lock:
+            self._conn.execute(
+                "UPDATE leases SET status = ?, expires = ? WHERE path = ? AND worker_id = ?",
+                ("done" if done else "failed", time.time() + retry_after, path, worker_id))
+            self._conn.commit()
+
+    def report_worker(self, worker_id: str, documents: int, pages: int, started: float) -> None:
+        """ Record the throughput counters of a worker. """
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?, ?)",
+                (worker_id, documents, pages, started, time.time()))
+            self._conn.commit()
+
+    def worker_stats(self) -> list:
+        """ Return the throughput of every worker that reported.
+        Returns:
+            list: One dictionary per worker with documents, pages and rates per second.
+        """
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT worker_id, documents, pages, started, updated FROM workers ORDER BY worker_id").fetchall()
+        stats = []
+        for worker_id, documents, pages, started, updated in rows:
+            elapsed = max(updated - started, 1e-9)
+            stats.append({
+                "worker_id": worker_id,
+                "documents": documents,
+                "pages": pages,
+                "documents_per_s": round(documents / elapsed, 3),
+                "pages_per_s": round(pages / elapsed, 3)
+            })
+        return stats
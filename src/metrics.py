@@ -0,0 +1,146 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+# Histogram bucket upper bounds for stage durations, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Collectors active in the current context, see Metrics.collect
+_collectors: ContextVar[tuple] = ContextVar("metrics_collectors", default=())
+
+
+class Histogram:
+    """ Cumulative histogram with fixed buckets, in Prometheus style. """
+
+    def __init__(self, buckets: tuple = DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class StageTimings:
+    """ Per-stage call counts and durations collected for one unit of work. """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        calls, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+        self.stages[stage] = (calls + 1, total + seconds, max(longest, seconds))
+
+    def rows(self) -> list:
+        """ Return one dictionary per stage, in the order stages first ran. """
+
+        return [{
+            "Stage": stage,
+            "Calls": calls,
+            "Total (s)": round(total, 3),
+            "Mean (ms)": round(total / calls * 1000, 1),
+            "Max (ms)": round(longest * 1000, 1)
+        } for stage, (calls, total, longest) in self.stages.items()]
+
+
+class Metrics:
+    """ Lightweight in-process registry of stage spans and counters.
+    Spans are aggregated into per-stage duration histograms, counters track
+    bytes sent and tokens, and everything can be exported as a Prometheus
+    text file.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """ Record the duration of one stage execution. """
+
+        with self._lock:
+            self.histograms.setdefault(stage, Histogram()).observe(seconds)
+        for collector in _collectors.get():
+            collector.add(stage, seconds)
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        """ Increase a counter, e.g. increment("bytes_sent", 1024, target="document_intelligence"). """
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """ Time the enclosed block as one execution of a stage. """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    @contextmanager
+    def collect(self) -> Iterator[StageTimings]:
+        """ Collect the spans recorded in the enclosed block, including those
+        of asyncio tasks and worker threads started from it.
+        Yields:
+            StageTimings: The per-stage breakdown, filled in as spans finish.
+        """
+
+        timings = StageTimings()
+        token = _collectors.set(_collectors.get() + (timings,))
+        try:
+            yield timings
+        finally:
+            _collectors.reset(token)
+
+    def to_prometheus(self) -> str:
+        """ Render all metrics in the Prometheus text exposition format. """
+
+        lines = [
+            "# HELP invoice_stage_duration_seconds Duration of pipeline stages.",
+            "# TYPE invoice_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(
+                        f'invoice_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'invoice_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'invoice_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE invoice_{name}_total counter")
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                        lines.append(f"invoice_{name}_total{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str = None) -> None:
+        """ Write the Prometheus text file, e.g. for the node exporter textfile collector.
+        Args:
+            path (str): The output file. Defaults to METRICS_EXPORT_PATH; nothing is written if unset.
+        """
+
+        path = path or os.getenv("METRICS_EXPORT_PATH")
+        if not path:
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+# Process-wide registry
+metrics = Metrics()
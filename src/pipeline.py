@@ -0,0 +1,330 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+from typing import Callable, Union
+from foundry_service import FoundryService
+from doc_intel_service import DocumentIntelligenceService
+from job_store import JobStore
+from folder_index import load_invoices
+from utils import get_pdf_page_count
+from metrics import metrics
+from invoice_model import Invoice
+from invoice_export import InvoiceExporter
+from duplicate_index import plan_extraction, copy_invoices
+from dotenv import load_dotenv
+
+# Page keys written to the output records and the job store
+PAGE_RECORD_KEYS = ("page_num", "is_invoice", "decided_by", "duplicate_of", "input_tokens", "output_tokens",
+                    "payload_bytes")
+
+# Default location of the job ledger
+DEFAULT_JOB_STORE_PATH = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), "..", ".cache", "jobs.sqlite"))
+
+
+async def process_document(foundry_service: FoundryService,
+                           document_intelligence_service: DocumentIntelligenceService,
+                           pdf_path: str, job_store: JobStore = None, doc_id: str = None) -> dict:
+    """ Classify and extract a single PDF without any UI.
+    With a job store, completed pages are loaded from the ledger instead of
+    being classified or extracted again, and progress is recorded per page.
+    Args:
+        foundry_service (FoundryService): The page classification service.
+        document_intelligence_service (DocumentIntelligenceService): The extraction service.
+        pdf_path (str): The path to the PDF file.
+        job_store (JobStore): Optional ledger used to resume interrupted runs.
+        doc_id (str): The document id from JobStore.document_id, hashed here when not given.
+    Returns:
+        dict: The document record with per-page verdicts, extracted invoices, token counts and timings.
+    """
+
+    if job_store:
+        doc_id = doc_id or await asyncio.to_thread(JobStore.document_id, pdf_path)
+        job_store.start_document(doc_id, pdf_path)
+
+    try:
+        record = await _process_document(
+            foundry_service, document_intelligence_service, pdf_path, job_store, doc_id)
+    except Exception as e:
+        if job_store:
+            job_store.fail_document(doc_id, str(e))
+        raise
+
+    if job_store:
+        job_store.finish_document(doc_id, record)
+    return record
+
+
+async def _process_document(foundry_service: FoundryService,
+                            document_intelligence_service: DocumentIntelligenceService,
+                            pdf_path: str, job_store: Union[JobStore, None], doc_id: Union[str, None]) -> dict:
+    started = time.perf_counter()
+    first_invoice = None
+
+    # Skip pages already classified or extracted by a previous run, and record progress per page
+    known_results, known_invoices, on_page = {}, {}, None
+    if job_store:
+        known_results = job_store.get_pages(doc_id, "classified")
+        known_invoices = {page_num: [Invoice.from_dict(invoice) for invoice in invoices]
+                          for page_num, invoices in job_store.get_pages(doc_id, "extracted").items()}
+
+        def on_page(page: dict) -> None:
+            job_store.complete_page(doc_id, page["page_num"], "classified",
+                                    {key: page.get(key) for key in PAGE_RECORD_KEYS})
+
+    def on_invoices(page_num: int, invoices: list[Invoice]) -> None:
+        nonlocal first_invoice
+        first_invoice = first_invoice or time.perf_counter()
+        if job_store and page_num not in known_invoices:
+            job_store.complete_page(doc_id, page_num, "extracted", [invoice.to_dict() for invoice in invoices])
+
+    pages, invoices_by_page = await classify_and_extract(
+        foundry_service, document_intelligence_service, pdf_path,
+        known_results=known_results, known_invoices=known_invoices, on_page=on_page, on_invoices=on_invoices)
+    invoices = [invoice.to_dict() for _, page_invoices in sorted(invoices_by_page.items())
+                for invoice in page_invoices]
+    finished = time.perf_counter()
+
+    input_tokens = sum(int(page["input_tokens"] or 0) for page in pages)
+    output_tokens = sum(int(page["output_tokens"] or 0) for page in pages)
+    return {
+        "file": os.path.basename(pdf_path),
+        "status": "ok",
+        "pages": [{key: page.get(key) for key in PAGE_RECORD_KEYS} for page in pages],
+        "invoices": invoices,
+        "tokens": {"input": input_tokens, "output": output_tokens, "total": input_tokens + output_tokens},
+        "timings": {
+            "first_invoice_s": round(first_invoice - started, 3) if first_invoice else None,
+            "total_s": round(finished - started, 3)
+        }
+    }
+
+
+def _invoice_run(verdicts: dict[int, dict], page_num: int, page_count: int) -> Union[list[int], None]:
+    """ Return the run of consecutive invoice pages around a page, once it is settled.
+    A run is settled when all its pages are classified as invoices and the pages
+    on either side are classified as non-invoices or are past the document's ends.
+    Args:
+        verdicts (dict[int, dict]): Page number mapped to the page result, for the pages classified so far.
+        page_num (int): A page of the run.
+        page_count (int): The number of pages in the document.
+    Returns:
+        Union[list[int], None]: The page numbers of the run, or None if the page is not an
+                                invoice page or the run is not settled yet.
+    """
+
+    if page_num not in verdicts or not verdicts[page_num]["is_invoice"]:
+        return None
+    start, end = page_num, page_num
+    while start > 1 and verdicts.get(start - 1, {}).get("is_invoice"):
+        start -= 1
+    while end < page_count and verdicts.get(end + 1, {}).get("is_invoice"):
+        end += 1
+    if (start > 1 and start - 1 not in verdicts) or (end < page_count and end + 1 not in verdicts):
+        return None
+    return list(range(start, end + 1))
+
+
+async def classify_and_extract(foundry_service: FoundryService,
+                               document_intelligence_service: DocumentIntelligenceService,
+                               pdf_path: str, known_results: dict = None, known_invoices: dict = None,
+                               on_page: Callable[[dict], None] = None,
+                               on_invoices: Callable[[int, list[Invoice]], None] = None
+                               ) -> tuple[list, dict[int, list[Invoice]]]:
+    """ Classify the pages of a PDF and extract its invoices as a pipeline.
+    Consecutive invoice pages are extracted together in one request, so an
+    invoice running over several pages is analyzed as a whole. Each run is
+    sent as soon as its pages and the pages around it are classified, while
+    the rest of the document is still being classified. The runs only depend
+    on the verdicts, so a rerun sends the same requests and hits the cache.
+    Args:
+        foundry_service (FoundryService): The page classification service.
+        document_intelligence_service (DocumentIntelligenceService): The extraction service.
+        pdf_path (str): The path to the PDF file.
+        known_results (dict): Page number mapped to a classification from a previous run.
+        known_invoices (dict): Page number mapped to invoices from a previous run.
+        on_page (Callable[[dict], None]): Called with each new page result as soon as it is decided.
+        on_invoices (Callable[[int, list[Invoice]], None]): Called with the invoices of each
+                                                            invoice page as soon as they are known.
+    Returns:
+        tuple: The page results ordered by page number, and page number mapped to its invoices.
+    """
+
+    document = os.path.abspath(pdf_path)
+    duplicate_index = foundry_service.duplicate_index
+    known_results = known_results or {}
+    known_invoices = known_invoices or {}
+    page_count = await asyncio.to_thread(get_pdf_page_count, pdf_path) or 0
+    verdicts = dict(known_results)
+    invoices_by_page, pending_copies = {}, {}
+    dispatched, extractions = set(), set()
+    document_bytes = None
+
+    def publish(page_num: int, invoices: list[Invoice]) -> None:
+        invoices_by_page[page_num] = invoices
+        if on_invoices:
+            on_invoices(page_num, invoices)
+        # Copies of this page were waiting for its invoices
+        for copy_page, original in list(pending_copies.items()):
+            if original == page_num:
+                del pending_copies[copy_page]
+                publish(copy_page, copy_invoices(invoices, copy_page))
+
+    async def extract(page_nums: list[int]) -> None:
+        nonlocal document_bytes
+        if document_bytes is None:
+            with open(pdf_path, "rb") as f:
+                document_bytes = f.read()
+        new_invoices = await document_intelligence_service.analyze_invoice_pages_async(document_bytes, page_nums)
+        for page_num, invoices in new_invoices.items():
+            if duplicate_index:
+                duplicate_index.set_invoices(document, page_num, [invoice.to_dict() for invoice in invoices])
+            publish(page_num, invoices)
+
+    async def extract_run(run: list[int]) -> None:
+        for page_num in run:
+            if page_num in known_invoices:
+                publish(page_num, known_invoices[page_num])
+        # A copy waits for its original whenever that is known to be an invoice, even if the
+        # original's run is not settled yet, so the requests do not depend on verdict timing
+        to_extract, reused, copies = plan_extraction(
+            [verdicts[page_num] for page_num in run if page_num not in known_invoices],
+            document, duplicate_index,
+            {page_num for page_num, verdict in verdicts.items() if verdict["is_invoice"]})
+        for page_num, invoices in reused.items():
+            publish(page_num, invoices)
+        for copy_page, original in copies.items():
+            if original in invoices_by_page:
+                publish(copy_page, copy_invoices(invoices_by_page[original], copy_page))
+            else:
+                pending_copies[copy_page] = original
+        if to_extract:
+            await extract(to_extract)
+
+    def dispatch_settled_runs(page_num: int) -> None:
+        # A verdict can settle the run it belongs to or the runs next to it
+        for neighbour in (page_num - 1, page_num, page_num + 1):
+            run = _invoice_run(verdicts, neighbour, page_count)
+            if run and run[0] not in dispatched:
+                dispatched.add(run[0])
+                extractions.add(asyncio.create_task(extract_run(run)))
+
+    def page_decided(page: dict) -> None:
+        if on_page:
+            on_page(page)
+        verdicts[page["page_num"]] = page
+        dispatch_settled_runs(page["page_num"])
+
+    for page_num in sorted(known_results):
+        dispatch_settled_runs(page_num)
+    classification = asyncio.create_task(foundry_service.pre_process_pdf_async(
+        pdf_path, known_results=known_results, on_page=page_decided))
+    try:
+        # Wait for classification and every extraction, failing as soon as one of them fails
+        while not classification.done() or extractions:
+            pending = set(extractions) if classification.done() else {classification, *extractions}
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                extractions.discard(task)
+                task.result()
+        pages = classification.result()
+
+        # Copies whose original was never extracted are extracted themselves
+        if pending_copies:
+            await extract(sorted(pending_copies))
+    finally:
+        for task in (classification, *extractions):
+            task.cancel()
+    return pages, invoices_by_page
+
+
+async def process_folder(folder_path: str, output_path: str, max_documents: int = 4,
+                         job_store: JobStore = None, exporter: InvoiceExporter = None) -> int:
+    """ Process every PDF in a folder concurrently and write one JSONL record per document.
+    Records are appended as soon as each document finishes. With a job store,
+    documents completed by a previous run are skipped.
+    Args:
+        folder_path (str): The folder containing the PDF files.
+        output_path (str): The JSONL file to append results to.
+        max_documents (int): Maximum number of documents processed at once.
+        job_store (JobStore): Optional ledger used to resume interrupted runs.
+        exporter (InvoiceExporter): Optional Parquet export of the extracted invoices.
+    Returns:
+        int: The number of documents that failed.
+    """
+
+    foundry_service = FoundryService()
+    document_intelligence_service = DocumentIntelligenceService()
+
+    file_names = [record["Name"] for record in load_invoices(folder_path)
+                  if record["Name"].lower().endswith(".pdf")]
+    # Hash each document once, off the event loop, and skip those already done
+    doc_ids = {}
+    if job_store:
+        for file_name in file_names:
+            doc_ids[file_name] = await asyncio.to_thread(
+                JobStore.document_id, os.path.join(folder_path, file_name))
+        file_names = [file_name for file_name in file_names
+                      if (job_store.get_document(doc_ids[file_name]) or {}).get("status") != "done"]
+    semaphore = asyncio.Semaphore(max_documents)
+    failures = 0
+
+    async def run(file_name: str) -> dict:
+        async with semaphore:
+            try:
+                return await process_document(
+                    foundry_service, document_intelligence_service,
+                    os.path.join(folder_path, file_name), job_store, doc_ids.get(file_name))
+            except Exception as e:
+                return {"file": file_name, "status": "error", "error": str(e)}
+
+    try:
+        with open(output_path, "a", encoding="utf-8") as output:
+            for task in asyncio.as_completed([run(file_name) for file_name in file_names]):
+                record = await task
+                if record["status"] != "ok":
+                    failures += 1
+                elif exporter:
+                    exporter.add(record["file"], record["invoices"])
+                output.write(json.dumps(record) + "\n")
+                output.flush()
+                print(f"{record['file']}: {record['status']}")
+    finally:
+        await document_intelligence_service.close()
+        if exporter:
+            exporter.flush()
+    return failures
+
+
+def main():
+    # Load environment variables from .env file
+    load_dotenv(override=True)
+
+    workspace_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    parser = argparse.ArgumentParser(description="Classify and extract invoices from a folder of PDFs.")
+    parser.add_argument("--input", default=os.path.join(workspace_root, "documents"),
+                        help="Folder containing the PDF files (default: documents)")
+    parser.add_argument("--output", default="results.jsonl",
+                        help="JSONL file to append one record per document to")
+    parser.add_argument("--max-documents", type=int, default=int(os.getenv("PIPELINE_MAX_DOCUMENTS", "4")),
+                        help="Maximum number of documents processed at once")
+    parser.add_argument("--job-store", default=os.getenv("PIPELINE_JOB_STORE", DEFAULT_JOB_STORE_PATH),
+                        help="SQLite job ledger used to resume interrupted runs (empty to disable)")
+    parser.add_argument("--export", default=os.getenv("INVOICE_EXPORT_PATH", ""),
+                        help="Folder to append Parquet datasets of invoices and line items to (empty to disable)")
+    args = parser.parse_args()
+
+    job_store = JobStore(args.job_store) if args.job_store else None
+    exporter = InvoiceExporter(
+        args.export, int(os.getenv("INVOICE_EXPORT_BATCH_SIZE", "1000"))) if args.export else None
+    failures = asyncio.run(process_folder(args.input, args.output, args.max_documents, job_store, exporter))
+    if job_store:
+        print(f"Job store: {job_store.summary()}")
+    metrics.export()
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
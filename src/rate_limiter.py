@@ -0,0 +1,293 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from typing import Awaitable, Callable, Union
+
+# HTTP status codes worth retrying: timeouts, throttling and transient server errors
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Seconds to wait before checking again for a free concurrency slot
+SLOT_POLL_INTERVAL = 0.05
+
+
+class TokenBucket:
+    """ Token bucket refilled continuously at a per-minute budget. """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """ Return how long to wait until amount can be taken (0 if available now). """
+
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        """ Take amount from the bucket; negative amounts give tokens back. """
+
+        self.level = min(self.capacity, self.level - amount)
+
+
+def _status_and_retry_after(exc: BaseException) -> tuple[Union[int, None], Union[float, None]]:
+    """ Find the HTTP status code and Retry-After delay of an exception.
+    Looks at the exception and its causes, so SDK errors wrapped by the agent
+    framework are recognized too.
+    Args:
+        exc (BaseException): The raised exception.
+    Returns:
+        tuple: The status code (or None) and the Retry-After delay in seconds (or None).
+    """
+
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        response = getattr(exc, "response", None)
+        status = getattr(exc, "status_code", None) or getattr(response, "status_code", None)
+        if isinstance(status, int):
+            headers = getattr(response, "headers", None) or {}
+            retry_after = None
+            for header, scale in (("retry-after-ms", 0.001), ("x-ms-retry-after-ms", 0.001), ("retry-after", 1)):
+                value = headers.get(header)
+                if value is not None:
+                    try:
+                        retry_after = float(value) * scale
+                        break
+                    except ValueError:
+                        continue
+            return status, retry_after
+        exc = exc.__cause__ or exc.__context__
+    return None, None
+
+
+class AdaptiveRateLimiter:
+    """ Shared scheduler for calls to a rate-limited Azure endpoint.
+    Enforces requests-per-minute and tokens-per-minute budgets with token
+    buckets, adapts the number of concurrent calls AIMD-style (halved on
+    throttling, increased by one per window of successes) and retries
+    throttled or failed calls with jittered exponential backoff that
+    honours Retry-After. Safe to share between threads and event loops.
+    The wrapped SDK clients must not retry by themselves, otherwise they
+    absorb the throttling responses the limits are adapted to.
+    """
+
+    def __init__(self, name: str, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 max_concurrency: int = 16, min_concurrency: int = 1, max_retries: int = 5,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0):
+        self.name = name
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency_limit = float(max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.in_flight = 0
+        self.queue_depth = 0
+        self.throttled = 0
+        self.retries = 0
+        # Running estimate of tokens per request, corrected with the actual usage
+        self.tokens_per_request = 1000.0
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, tokens: float) -> float:
+        """ Take a concurrency slot and budget if available.
+        Returns:
+            float: 0 if acquired, otherwise the number of seconds to wait before retrying.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if self.in_flight >= int(self.concurrency_limit):
+                return SLOT_POLL_INTERVAL
+            waits = [bucket.wait_time(amount, now) for bucket, amount in (
+                (self.request_bucket, 1), (self.token_bucket, tokens)) if bucket]
+            wait = max(waits, default=0)
+            if wait > 0:
+                return wait
+            if self.request_bucket:
+                self.request_bucket.take(1)
+            if self.token_bucket:
+                self.token_bucket.take(tokens)
+            self.in_flight += 1
+            return 0
+
+    def _release(self, estimated_tokens: float, actual_tokens: Union[int, None], succeeded: bool,
+                 throttled: bool = False, retry_after: Union[float, None] = None) -> None:
+        """ Return the concurrency slot and adapt the limits to the outcome.
+        Only throttling lowers the limit and only successes raise it, so
+        timeouts and server errors leave the concurrency unchanged.
+        """
+
+        with self._lock:
+            self.in_flight -= 1
+            if actual_tokens is not None:
+                if self.token_bucket:
+                    self.token_bucket.take(actual_tokens - estimated_tokens)
+                self.tokens_per_request = 0.9 * self.tokens_per_request + 0.1 * actual_tokens
+            if throttled:
+                # Multiplicative decrease and a shared pause for every caller
+                self.throttled += 1
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            elif succeeded:
+                # Additive increase: about one extra slot per window of successes
+                self.concurrency_limit = min(
+                    self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+
+    def _retry_delay(self, attempt: int, retry_after: Union[float, None]) -> float:
+        """ Return the jittered delay before a retry. """
+
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def retry_delay(self, exc: Exception, attempt: int) -> Union[float, None]:
+        """ Return how long to wait before retrying a call made outside the limits,
+        such as a free LRO status poll, or None if it should not be retried.
+        Such calls take no slot, so they do not adapt the limits either.
+        Args:
+            exc (Exception): The raised exception.
+            attempt (int): The number of retries so far.
+        Returns:
+            Union[float, None]: The jittered delay in seconds, or None.
+        """
+
+        retry, _, retry_after = self._should_retry(exc, attempt)
+        return self._retry_delay(attempt, retry_after) if retry else None
+
+    def _should_retry(self, exc: Exception, attempt: int) -> tuple[bool, bool, Union[float, None]]:
+        """ Classify a failed call.
+        Returns:
+            tuple: Whether to retry, whether the call was throttled and the Retry-After delay.
+        """
+
+        status, retry_after = _status_and_retry_after(exc)
+        retryable = status in RETRY_STATUS_CODES and attempt < self.max_retries
+        return retryable, status == 429, retry_after
+
+    async def run_async(self, call: Callable[[], Awaitable], usage: Callable[[object], int] = None,
+                        tokens: float = None):
+        """ Run an async call under the budgets, retrying throttled and transient failures.
+        Args:
+            call (Callable[[], Awaitable]): Creates the awaitable to run; called again for each attempt.
+            usage (Callable[[object], int]): Returns the tokens actually used from the call result.
+            tokens (float): Estimated tokens for the call. Defaults to the running average.
+        Returns:
+            The result of the call.
+        """
+
+        attempt = 0
+        while True:
+            estimated = tokens or self.tokens_per_request
+            with self._lock:
+                self.queue_depth += 1
+            try:
+                while (wait := self._try_acquire(estimated)) > 0:
+                    await asyncio.sleep(wait)
+            finally:
+                with self._lock:
+                    self.queue_depth -= 1
+
+            try:
+                result = await call()
+            except Exception as e:
+                retry, throttled, retry_after = self._should_retry(e, attempt)
+                self._release(estimated, None, False, throttled, retry_after)
+                if not retry:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(self._retry_delay(attempt, retry_after))
+                attempt += 1
+                continue
+            self._release(estimated, usage(result) if usage else None, True)
+            return result
+
+    def run_sync(self, call: Callable[[], object], usage: Callable[[object], int] = None,
+                 tokens: float = None):
+        """ Blocking counterpart of run_async for synchronous SDK calls.
+        Args:
+            call (Callable[[], object]): Performs the call; called again for each attempt.
+            usage (Callable[[object], int]): Returns the tokens actually used from the call result.
+            tokens (float): Estimated tokens for the call. Defaults to the running average.
+        Returns:
+            The result of the call.
+        """
+
+        attempt = 0
+        while True:
+            estimated = tokens or self.tokens_per_request
+            with self._lock:
+                self.queue_depth += 1
+            try:
+                while (wait := self._try_acquire(estimated)) > 0:
+                    time.sleep(wait)
+            finally:
+                with self._lock:
+                    self.queue_depth -= 1
+
+            try:
+                result = call()
+            except Exception as e:
+                retry, throttled, retry_after = self._should_retry(e, attempt)
+                self._release(estimated, None, False, throttled, retry_after)
+                if not retry:
+                    raise
+                self.retries += 1
+                time.sleep(self._retry_delay(attempt, retry_after))
+                attempt += 1
+                continue
+            self._release(estimated, usage(result) if usage else None, True)
+            return result
+
+    def stats(self) -> dict:
+        """ Return the current scheduler state. """
+
+        with self._lock:
+            return {
+                "name": self.name,
+                "queue_depth": self.queue_depth,
+                "in_flight": self.in_flight,
+                "concurrency_limit": int(self.concurrency_limit),
+                "throttled": self.throttled,
+                "retries": self.retries
+            }
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name: str) -> AdaptiveRateLimiter:
+    """ Return the process-wide rate limiter for an endpoint, configured from
+    the environment: <NAME>_RPM, <NAME>_TPM, <NAME>_MAX_CONCURRENCY and
+    <NAME>_MAX_RETRIES, where 0 disables a budget.
+    Args:
+        name (str): The endpoint name, e.g. "AZURE_OPENAI" or "DOCUMENT_INTELLIGENCE".
+    Returns:
+        AdaptiveRateLimiter: The shared rate limiter.
+    """
+
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            _rate_limiters[name] = AdaptiveRateLimiter(
+                name,
+                requests_per_minute=float(os.getenv(f"{name}_RPM", "0")),
+                tokens_per_minute=float(os.getenv(f"{name}_TPM", "0")),
+                max_concurrency=int(os.getenv(f"{name}_MAX_CONCURRENCY", "16")),
+                max_retries=int(os.getenv(f"{name}_MAX_RETRIES", "5")))
+        return _rate_limiters[name]
@@ -0,0 +1,37 @@
+# Canned service results shared by the benchmark's simulated clients and the endpoint emulator
+
+
+def simulated_invoice(page_num: int) -> dict:
+    """ Return an analyzed invoice document in the service's JSON shape.
+    Args:
+        page_num (int): The page the invoice is located on.
+    Returns:
+        dict: The document JSON, as found in AnalyzeResult.documents.
+    """
+
+    def field(content: str, **value) -> dict:
+        return {"type": "string", "content": content, "confidence": 0.95, **value}
+
+    return {
+        "docType": "invoice",
+        "confidence": 0.95,
+        "spans": [],
+        "boundingRegions": [{"pageNumber": page_num, "polygon": []}],
+        "fields": {
+            "VendorName": field("Fabrikam Inc"),
+            "CustomerName": field("Contoso Ltd"),
+            "InvoiceId": field(f"INV-{page_num:05d}"),
+            "InvoiceDate": field("2024-03-01", type="date", valueDate="2024-03-01"),
+            "InvoiceTotal": field("120.00 USD", type="currency",
+                                  valueCurrency={"amount": 120.0, "currencyCode": "USD"}),
+            "Items": {"type": "array", "valueArray": [{
+                "type": "object",
+                "valueObject": {
+                    "Description": field("Consulting services"),
+                    "Quantity": field("1", type="number", valueNumber=1),
+                    "Amount": field("100.00", type="currency",
+                                    valueCurrency={"amount": 100.0, "currencyCode": "USD"}),
+                }
+            }]}
+        }
+    }
@@ -0,0 +1,80 @@
+import re
+from typing import Union
+
+# Terms that are specific to invoices
+INVOICE_TERMS = ("invoice", "rechnung", "facture", "factura", "fattura", "faktura")
+
+# Financial terms that commonly appear on invoices and related documents
+FINANCIAL_TERMS = (
+    "total due", "amount due", "balance due", "subtotal", "sub total", "vat",
+    "tax", "due date", "bill to", "payment terms", "remit to", "unit price", "qty", "quantity",
+)
+
+# Monetary amounts such as 1,234.56 or 99,90
+AMOUNT_PATTERN = re.compile(r"\d{1,3}(?:[.,\s]\d{3})*[.,]\d{2}\b")
+
+# Column headers of a line-item table
+LINE_ITEM_HEADER_PATTERN = re.compile(r"\b(?:qty|quantity|unit price)\b")
+
+# Lines of a totals block, each followed by an amount
+TOTAL_LINE_PATTERN = re.compile(r"\b(?:total|total due|amount due|balance due)\b")
+SUBTOTAL_LINE_PATTERN = re.compile(r"\b(?:subtotal|sub total|net|vat|tax)\b")
+
+
+def _has_line_items(lines: list[str]) -> bool:
+    """ Whether the lines hold a line-item table: a header with quantity or unit price
+    columns, followed by at least two rows that each carry a unit price and an amount. """
+
+    for index, line in enumerate(lines):
+        if LINE_ITEM_HEADER_PATTERN.search(line):
+            rows = [row for row in lines[index + 1:] if len(AMOUNT_PATTERN.findall(row)) >= 2]
+            return len(rows) >= 2
+    return False
+
+
+def _has_totals(lines: list[str]) -> bool:
+    """ Whether the lines hold a totals block: a total and a subtotal or tax line, both with amounts. """
+
+    amount_lines = [line for line in lines if AMOUNT_PATTERN.search(line)]
+    return (any(TOTAL_LINE_PATTERN.search(line) for line in amount_lines)
+            and any(SUBTOTAL_LINE_PATTERN.search(line) for line in amount_lines))
+
+
+def classify_page_text(text: str, has_graphics: bool) -> Union[bool, None]:
+    """ Classify a page from its text layer when the answer is obvious.
+    Args:
+        text (str): The text extracted from the page's text layer.
+        has_graphics (bool): Whether the page contains images or vector drawings.
+    Returns:
+        Union[bool, None]: True for an obvious invoice, False for an obviously
+                           blank or non-invoice page, None when the page is
+                           ambiguous and should go to the model.
+    """
+
+    lines = [" ".join(line.split()) for line in text.lower().splitlines() if line.strip()]
+    normalized = " ".join(lines)
+    words = normalized.split()
+
+    # Blank page: no text layer and nothing drawn on it
+    if not words:
+        return False if not has_graphics else None
+
+    # Too little text to decide, e.g. a scanned page with a stamp or a header
+    if len(words) < 30:
+        return None
+
+    invoice_hits = sum(1 for term in INVOICE_TERMS if re.search(rf"\b{term}\b", normalized))
+    financial_hits = sum(1 for term in FINANCIAL_TERMS if re.search(rf"\b{term}\b", normalized))
+    amount_hits = len(AMOUNT_PATTERN.findall(normalized))
+
+    # Digital invoice: names itself an invoice and has both a line-item table and a
+    # totals block. Reminders, statements and cover letters quote invoice numbers
+    # and amounts due too, but rarely both structures, and go to the model
+    if invoice_hits and _has_line_items(lines) and _has_totals(lines):
+        return True
+
+    # Digital page with plenty of text but nothing invoice-like on it
+    if not invoice_hits and not financial_hits and amount_hits == 0:
+        return False
+
+    return None
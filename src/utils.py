@@ -1,78 +1,326 @@
 import os
-import base64
-from PyPDF2 import PdfReader  # PyPDF2 is used to read PDF files
+import threading
+import multiprocessing
+import contextvars
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import fitz  # PyMuPDF is used to convert PDF pages to images
 import numpy as np
-import base64
-from typing import Union
+from typing import Callable, Iterator, Union
+from metrics import metrics
 
+# PyMuPDF is not thread-safe, so every use of fitz in a process runs on one
+# dedicated thread. The executor is created per process, as render workers
+# and forked processes do not share its thread
+_fitz_executor, _fitz_executor_pid = None, None
+_fitz_executor_lock = threading.Lock()
+_fitz_thread = threading.local()
 
-def get_pdf_page_count(pdf_path: str) -> Union[int, None]:
+
+# Render processes are shared by all documents and created on first use
+_render_executor, _render_executor_key = None, None
+_render_executor_lock = threading.Lock()
+
+
+def _mark_fitz_thread() -> None:
+    _fitz_thread.active = True
+
+
+def _get_fitz_executor() -> ThreadPoolExecutor:
+    global _fitz_executor, _fitz_executor_pid
+    with _fitz_executor_lock:
+        if _fitz_executor_pid != os.getpid():
+            _fitz_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="fitz", initializer=_mark_fitz_thread)
+            _fitz_executor_pid = os.getpid()
+        return _fitz_executor
+
+
+def run_fitz(func: Callable, *args):
+    """ Run a function that uses PyMuPDF on the dedicated fitz thread and wait for its result.
+    Args:
+        func (Callable): The function to run.
+        *args: Its arguments.
+    Returns:
+        The result of the function.
+    """
+
+    # Already on the fitz thread, e.g. a nested call
+    if getattr(_fitz_thread, "active", False):
+        return func(*args)
+    # Run in the caller's context, so spans recorded on the fitz thread reach its metrics collectors
+    return _get_fitz_executor().submit(contextvars.copy_context().run, func, *args).result()
+
+
+def _page_count(pdf: Union[str, bytes]) -> Union[int, None]:
+    try:
+        with (fitz.open(pdf) if isinstance(pdf, str) else fitz.open(stream=pdf, filetype="pdf")) as doc:
+            return doc.page_count
+    except Exception:
+        return None
+
+
+def get_pdf_page_count(pdf_path: Union[str, bytes]) -> Union[int, None]:
     """ Returns the number of pages in a PDF file, or 
         None if the file cannot be read. 
+        Only the document structure is read, not the page contents.
 
     Args:
-        pdf_path (str): The path to the PDF file.
+        pdf_path (Union[str, bytes]): The path to the PDF file, or its content.
     Returns:
         Union[int, None]: The number of pages in the PDF,
                           or None if the file cannot be read.
     """
 
-    try:
-        reader = PdfReader(pdf_path)
-        return len(reader.pages)
-    except Exception:
-        return None
+    return run_fitz(_page_count, pdf_path)
+
+
+# Named rendering profiles: a small grayscale JPEG is enough for the
+# Yes/No classifier, while display keeps the original 300 DPI PNG output
+RENDER_PROFILES = {
+    "classification": {"dpi": 100, "format": "jpeg", "grayscale": True, "max_dimension": 1024, "jpg_quality": 75},
+    "display": {"dpi": 300, "format": "png", "grayscale": False, "max_dimension": None, "jpg_quality": 95},
+    "thumbnail": {"dpi": 72, "format": "jpeg", "grayscale": False, "max_dimension": 400, "jpg_quality": 70},
+}
+
+
+def get_render_profile(name: str = None) -> dict:
+    """ Return a rendering profile by name.
+    Args:
+        name (str): The profile name. Defaults to the RENDER_PROFILE
+                    environment variable, or "display".
+    Returns:
+        dict: The rendering settings (dpi, format, grayscale, max_dimension, jpg_quality).
+    """
+
+    name = name or os.getenv("RENDER_PROFILE", "display")
+    if name not in RENDER_PROFILES:
+        raise ValueError(
+            f"Unknown render profile '{name}'. Available profiles: {', '.join(RENDER_PROFILES)}")
+    return RENDER_PROFILES[name]
+
+
+def perceptual_hash(pix: fitz.Pixmap, hash_size: int = 16) -> str:
+    """ Compute a difference hash of a rendered page.
+    The image is averaged down to hash_size rows of hash_size + 1 cells, and
+    each bit tells whether a cell is brighter than its left neighbour, so
+    re-scanned or re-compressed copies of a page get nearly the same hash.
+    Args:
+        pix (fitz.Pixmap): The rendered page.
+        hash_size (int): Number of rows and bits per row of the hash.
+    Returns:
+        str: The hash as hex string of hash_size * hash_size bits.
+    """
+
+    samples = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    samples = samples[:, :pix.width * pix.n].reshape(pix.height, pix.width, pix.n).astype(np.float32)
+    gray = samples[..., :3].mean(axis=2) if pix.n >= 3 else samples[..., 0]
+
+    # Average pooling with cell edges spread evenly over the image
+    row_edges = np.linspace(0, pix.height, hash_size + 1).astype(int)
+    col_edges = np.linspace(0, pix.width, hash_size + 2).astype(int)
+    cells = np.add.reduceat(np.add.reduceat(gray, row_edges[:-1], axis=0), col_edges[:-1], axis=1)
+    cells /= np.outer(np.diff(row_edges), np.diff(col_edges))
+    bits = cells[:, 1:] > cells[:, :-1]
+    return np.packbits(bits.flatten()).tobytes().hex()
+
+
+def _pixmap(page: fitz.Page, profile: dict) -> fitz.Pixmap:
+    """ Rasterize a page at the profile's resolution, capped to its maximum dimension. """
+
+    zoom = profile["dpi"] / 72
+    max_dimension = profile.get("max_dimension")
+    if max_dimension:
+        longest_side = max(page.rect.width, page.rect.height) * zoom
+        if longest_side > max_dimension:
+            zoom *= max_dimension / longest_side
+
+    return page.get_pixmap(
+        matrix=fitz.Matrix(zoom, zoom),
+        colorspace=fitz.csGRAY if profile.get("grayscale") else fitz.csRGB)
+
 
+def _encode(pix: fitz.Pixmap, profile: dict) -> bytes:
+    """ Encode a rendered page in the profile's image format. """
 
-def load_invoices(folder_path: str):
-    """ Load invoice files from a folder and return a 
-        list of dictionaries with file information. 
-        Each dictionary contains the file name, size in KB, 
-        number of pages (if applicable).
+    if profile["format"] == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=profile.get("jpg_quality", 95))
+    return pix.tobytes(profile["format"])
+
+
+def render_page(page: fitz.Page, profile: dict) -> dict:
+    """ Render a single PDF page with the given rendering profile.
+    Rasterization and image encoding are timed as separate stages.
     Args:
-        folder_path (str): The path to the folder containing invoice files.
+        page (fitz.Page): The page to render.
+        profile (dict): The rendering settings from get_render_profile.
     Returns:
-        list: A list of dictionaries with file information.
+        dict: A dictionary containing page number, image bytes, media type,
+              payload size, text layer, whether the page has graphics and
+              the perceptual hash of the image.
     """
 
-    invoice_records = []
-    if os.path.exists(folder_path):
-        for filename in os.listdir(folder_path):
-            file_path = os.path.join(folder_path, filename)
-            if os.path.isfile(file_path):
-                size_kb = round(os.path.getsize(file_path) / 1024, 2)
-                pages = get_pdf_page_count(
-                    file_path) if filename.lower().endswith('.pdf') else None
-                invoice_records.append({
-                    "Name": filename,
-                    "Size (KB)": size_kb,
-                    "Pages": pages
-                })
-    return invoice_records
-
-
-def pdf_to_images(pdf_path: str) -> list:
-    """ Convert PDF to images and return each page as 
-    bytes and base64 strings. 
+    with metrics.span("rasterize"):
+        pix = _pixmap(page, profile)
+    with metrics.span("encode"):
+        img_bytes = _encode(pix, profile)
+    return {
+        "page_num": page.number+1,
+        "bytes": img_bytes,
+        "media_type": f"image/{profile['format']}",
+        "payload_bytes": len(img_bytes),
+        "text": page.get_text("text"),
+        "has_graphics": bool(page.get_images()) or bool(page.get_drawings()),
+        "phash": perceptual_hash(pix)
+    }
+
+
+def render_page_image(pdf_path: str, page_num: int, profile: str = None) -> dict:
+    """ Render only the image of a single page, e.g. a thumbnail or an image requested for display.
     Args:
         pdf_path (str): The path to the PDF file.
+        page_num (int): The 1-based page number.
+        profile (str): The rendering profile name, see get_render_profile.
     Returns:
-        list: A list of dictionaries containing page number,
-              bytes, and base64 strings for each page.
+        dict: A dictionary containing the image bytes and media type.
+    """
+
+    render_profile = get_render_profile(profile)
+    img_bytes = run_fitz(_render_page_image, pdf_path, page_num, render_profile)
+    return {"bytes": img_bytes, "media_type": f"image/{render_profile['format']}"}
+
+
+def _render_page_image(pdf_path: str, page_num: int, render_profile: dict) -> bytes:
+    with fitz.open(pdf_path) as doc:
+        with metrics.span("rasterize"):
+            pix = _pixmap(doc.load_page(page_num - 1), render_profile)
+        with metrics.span("encode"):
+            return _encode(pix, render_profile)
+
+
+def _get_render_executor(workers: int) -> ProcessPoolExecutor:
+    """ Return the shared render process pool, replacing it if the worker count changed.
+    Workers are spawned rather than forked, as forking while the fitz and I/O threads run
+    can copy locks held by those threads into the worker.
+    """
+
+    global _render_executor, _render_executor_key
+    with _render_executor_lock:
+        if _render_executor_key != (os.getpid(), workers):
+            if _render_executor and _render_executor_key[0] == os.getpid():
+                _render_executor.shutdown(wait=False)
+            _render_executor = ProcessPoolExecutor(max_workers=workers,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+            _render_executor_key = (os.getpid(), workers)
+        return _render_executor
+
+
+def _render_pages(pdf_path: str, page_indexes: list[int], render_profile: dict) -> list:
+    """ Render the given pages of a PDF in a worker process.
+    Each worker opens its own document, as fitz documents cannot be shared across processes.
+    Args:
+        pdf_path (str): The path to the PDF file.
+        page_indexes (list[int]): The 0-based page indexes to render.
+        render_profile (dict): The rendering settings from get_render_profile.
+    Returns:
+        list: The rendered page dictionaries, in page order.
     """
 
     doc = fitz.open(pdf_path)
-    images = []
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        pix = page.get_pixmap(dpi=300)
-        img_bytes = pix.tobytes("png")
-        img_base64 = base64.b64encode(img_bytes).decode("utf-8")
-        images.append(
-            {
-                "page_num": page_num+1,
-                "bytes": img_bytes,
-                "base64": img_base64
-            })
-    return images
+    try:
+        return [render_page(doc.load_page(page_num), render_profile) for page_num in page_indexes]
+    finally:
+        doc.close()
+
+
+def iter_pdf_pages(pdf_path: str, profile: str = None, workers: int = None,
+                   skip_pages: set = None) -> Iterator[dict]:
+    """ Lazily render PDF pages to images, one page at a time.
+    Only the image bytes are produced, never a base64 copy. Large documents are rendered in
+    parallel across a shared process pool, still yielding pages in order.
+    At most workers * RENDER_CHUNK_PAGES pages are rendered ahead of the caller.
+    Args:
+        pdf_path (str): The path to the PDF file.
+        profile (str): The rendering profile name, see get_render_profile.
+        workers (int): Number of render processes. Defaults to the RENDER_WORKERS
+                       environment variable, or the number of CPUs.
+        skip_pages (set): 1-based page numbers that should not be rendered.
+    Yields:
+        dict: A dictionary containing page number, image bytes, media type and payload size.
+    """
+
+    render_profile = get_render_profile(profile)
+    workers = workers or int(os.getenv("RENDER_WORKERS", "0")) or os.cpu_count() or 1
+    min_pages = int(os.getenv("RENDER_PARALLEL_MIN_PAGES", "16"))
+
+    doc = run_fitz(fitz.open, pdf_path)
+    page_indexes = [page_num for page_num in range(run_fitz(len, doc))
+                    if not skip_pages or page_num + 1 not in skip_pages]
+
+    # Small documents are not worth the process start-up cost
+    if workers <= 1 or len(page_indexes) < min_pages:
+        try:
+            for page_num in page_indexes:
+                yield run_fitz(_render_page_at, doc, page_num, render_profile)
+        finally:
+            run_fitz(doc.close)
+        return
+    run_fitz(doc.close)
+
+    # Split the pages into chunks and keep one chunk per worker in flight.
+    # A new chunk is only submitted once the caller has taken the pages of
+    # the oldest one, so unconsumed pages never exceed workers * chunk_size
+    chunk_size = int(os.getenv("RENDER_CHUNK_PAGES", "1"))
+    chunks = [page_indexes[start:start + chunk_size]
+              for start in range(0, len(page_indexes), chunk_size)]
+    executor = _get_render_executor(workers)
+    pending = deque()
+    try:
+        for chunk in chunks:
+            if len(pending) >= workers:
+                yield from _wait_for_pages(pending.popleft())
+            pending.append(executor.submit(_render_pages, pdf_path, chunk, render_profile))
+        while pending:
+            yield from _wait_for_pages(pending.popleft())
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _render_page_at(doc: fitz.Document, page_index: int, render_profile: dict) -> dict:
+    return render_page(doc.load_page(page_index), render_profile)
+
+
+def _wait_for_pages(future: Future) -> list:
+    """ Wait for a chunk rendered by a worker process, timing the wait as rasterization. """
+
+    with metrics.span("rasterize"):
+        return future.result()
+
+
+def extract_pdf_pages(document_bytes: bytes, pages: list[int]) -> bytes:
+    """ Build a new in-memory PDF containing only the given pages.
+    Args:
+        document_bytes (bytes): The source PDF content in bytes.
+        pages (list[int]): 1-based page numbers to keep, in output order.
+    Returns:
+        bytes: The PDF content of the subset, or the original bytes
+               if the selection already covers the whole document.
+    """
+
+    return run_fitz(_extract_pdf_pages, document_bytes, pages)
+
+
+def _extract_pdf_pages(document_bytes: bytes, pages: list[int]) -> bytes:
+    src = fitz.open(stream=document_bytes, filetype="pdf")
+    if list(pages) == list(range(1, len(src) + 1)):
+        src.close()
+        return document_bytes
+
+    subset = fitz.open()
+    for page_num in pages:
+        subset.insert_pdf(src, from_page=page_num - 1, to_page=page_num - 1)
+    subset_bytes = subset.tobytes(garbage=3, deflate=True)
+    subset.close()
+    src.close()
+    return subset_bytes
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import argparse
+import statistics
+from collections import deque
+from foundry_service import FoundryService
+from doc_intel_service import DocumentIntelligenceService
+from job_store import JobStore
+from invoice_export import InvoiceExporter
+from pipeline import process_document, DEFAULT_JOB_STORE_PATH
+from folder_index import FolderIndex, load_invoices, DEFAULT_FOLDER_INDEX_PATH
+from metrics import metrics
+from dotenv import load_dotenv
+
+
+async def _heartbeat(job_store: JobStore, path: str, worker_id: str, lease_seconds: float,
+                     task: asyncio.Task) -> None:
+    """ Renew a lease periodically until cancelled.
+    If the lease is lost, another worker now processes the document,
+    so the processing task is cancelled instead of duplicating its work.
+    """
+
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        if not job_store.renew_lease(path, worker_id, lease_seconds):
+            print(f"[{worker_id}] Lost lease on {path}, stopping")
+            task.cancel()
+            return
+
+
+def _is_stable(path: str, observed: dict, settle_seconds: float) -> bool:
+    """ Decide whether a file is fully written.
+    A file is stable once its size and modification time are the same as at
+    the previous scan and it was last modified at least settle_seconds ago.
+    Args:
+        path (str): The path to the file.
+        observed (dict): Path mapped to the size and modification time seen at the previous scan.
+        settle_seconds (float): Minimum time since the last modification.
+    Returns:
+        bool: True if the file can be processed.
+    """
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        observed.pop(path, None)
+        return False
+    signature = (stat.st_size, stat.st_mtime_ns)
+    previous = observed.get(path)
+    observed[path] = signature
+    return previous == signature and time.time() - stat.st_mtime >= settle_seconds
+
+
+async def run_worker(folder_path: str, output_path: str, job_store: JobStore, worker_id: str = None,
+                     max_documents: int = 2, lease_seconds: float = 60, poll_interval: float = 5,
+                     report_interval: float = 30, once: bool = False, exporter: InvoiceExporter = None,
+                     settle_seconds: float = 2) -> None:
+    """ Claim and process documents from a shared inbox until stopped.
+    Several workers, on one machine or several sharing the job store file,
+    can run against the same folder: each document is claimed through an
+    expiring lease that is renewed by a heartbeat while it is processed, so
+    documents held by a crashed worker are picked up again once the lease expires.
+    New and modified files are only claimed once they are fully written, and
+    only while there is capacity, so a burst of files waits in the inbox.
+    Args:
+        folder_path (str): The inbox folder containing the PDF files.
+        output_path (str): The JSONL file to append results to.
+        job_store (JobStore): The shared ledger holding leases and progress.
+        worker_id (str): The worker id. Defaults to host name and process id.
+        max_documents (int): Maximum number of documents this worker processes at once.
+        lease_seconds (float): Lease duration; heartbeats renew it every third of that.
+        poll_interval (float): Seconds between inbox scans when there is nothing to claim.
+        report_interval (float): Seconds between throughput reports.
+        once (bool): Exit once nothing is left to claim instead of polling forever.
+        exporter (InvoiceExporter): Optional Parquet export of the extracted invoices.
+        settle_seconds (float): Seconds a file must be left unchanged before it is claimed.
+    """
+
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    foundry_service = FoundryService()
+    document_intelligence_service = DocumentIntelligenceService()
+    # Inbox scans only read new or changed files
+    folder_index = FolderIndex(os.getenv("FOLDER_INDEX_PATH", DEFAULT_FOLDER_INDEX_PATH) or None)
+
+    started = time.time()
+    last_report = started
+    documents_done, pages_done = 0, 0
+    in_flight = {}
+    # Size and modification time of every inbox file at the previous scan, and of the files done here
+    observed, completed = {}, {}
+    # Seconds from the last write of a file to its results, for the most recent documents
+    latencies = deque(maxlen=1000)
+
+    async def process(path: str) -> dict:
+        try:
+            dropped = os.stat(path).st_mtime
+        except FileNotFoundError as e:
+            job_store.release_lease(path, worker_id, done=False, retry_after=lease_seconds)
+            return {"file": os.path.basename(path), "status": "error", "error": str(e)}
+        work = asyncio.create_task(process_document(
+            foundry_service, document_intelligence_service, path, job_store))
+        heartbeat = asyncio.create_task(_heartbeat(job_store, path, worker_id, lease_seconds, work))
+        try:
+            record = await work
+            job_store.release_lease(path, worker_id, done=True)
+            record["timings"]["latency_s"] = round(time.time() - dropped, 3)
+            return record
+        except asyncio.CancelledError:
+            # Cancelled by the heartbeat; the lease now belongs to another worker
+            if not heartbeat.done():
+                raise
+            return {"file": os.path.basename(path), "status": "error", "error": "Lost lease"}
+        except Exception as e:
+            job_store.release_lease(path, worker_id, done=False, retry_after=lease_seconds)
+            return {"file": os.path.basename(path), "status": "error", "error": str(e)}
+        finally:
+            heartbeat.cancel()
+            work.cancel()
+
+    def report() -> None:
+        elapsed = max(time.time() - started, 1e-9)
+        job_store.report_worker(worker_id, documents_done, pages_done, started)
+        print(f"[{worker_id}] {documents_done} documents, {pages_done} pages, "
+              f"{documents_done / elapsed:.2f} documents/s, {pages_done / elapsed:.2f} pages/s")
+        if latencies:
+            print(f"[{worker_id}] latency from file drop to results: "
+                  f"median {statistics.median(latencies):.2f} s, max {max(latencies):.2f} s")
+        for rate_limiter in (foundry_service.rate_limiter, document_intelligence_service.rate_limiter):
+            print(f"[{worker_id}] {rate_limiter.stats()}")
+        if exporter:
+            exporter.flush()
+        metrics.export()
+
+    while True:
+        # Claim documents up to the concurrency limit
+        settling = False
+        for record in await asyncio.to_thread(load_invoices, folder_path, folder_index):
+            if len(in_flight) >= max_documents:
+                break
+            path = os.path.join(folder_path, record["Name"])
+            if not path.lower().endswith(".pdf") or path in in_flight.values():
+                continue
+            # Wait until the file is fully written, and skip files this worker already processed
+            if not _is_stable(path, observed, settle_seconds):
+                settling = True
+                continue
+            if completed.get(path) == observed[path]:
+                continue
+            if job_store.claim_document(path, worker_id, lease_seconds):
+                in_flight[asyncio.create_task(process(path))] = path
+
+        if not in_flight:
+            if once and not settling:
+                break
+            await asyncio.sleep(poll_interval)
+            continue
+
+        done, _ = await asyncio.wait(in_flight, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+        with open(output_path, "a", encoding="utf-8") as output:
+            for task in done:
+                path = in_flight.pop(task)
+                record = task.result()
+                if record["status"] == "ok":
+                    documents_done += 1
+                    pages_done += len(record["pages"])
+                    latencies.append(record["timings"]["latency_s"])
+                    completed[path] = observed.get(path)
+                    if exporter:
+                        exporter.add(record["file"], record["invoices"])
+                # One write per record, so concurrent workers do not interleave lines
+                output.write(json.dumps(record) + "\n")
+                print(f"[{worker_id}] {record['file']}: {record['status']}")
+
+        if time.time() - last_report >= report_interval:
+            report()
+            last_report = time.time()
+
+    report()
+    await document_intelligence_service.close()
+
+
+def main():
+    # Load environment variables from .env file
+    load_dotenv(override=True)
+
+    workspace_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    parser = argparse.ArgumentParser(description="Process a shared inbox of PDFs with lease-based work claiming.")
+    parser.add_argument("--input", default=os.path.join(workspace_root, "documents"),
+                        help="Inbox folder containing the PDF files (default: documents)")
+    parser.add_argument("--output", default="results.jsonl",
+                        help="JSONL file to append one record per document to")
+    parser.add_argument("--job-store", default=os.getenv("PIPELINE_JOB_STORE", DEFAULT_JOB_STORE_PATH),
+                        help="Shared SQLite job ledger holding leases and progress")
+    parser.add_argument("--worker-id", default=None, help="Worker id (default: host name and process id)")
+    parser.add_argument("--max-documents", type=int, default=int(os.getenv("WORKER_MAX_DOCUMENTS", "2")),
+                        help="Maximum number of documents this worker processes at once")
+    parser.add_argument("--lease-seconds", type=float, default=float(os.getenv("WORKER_LEASE_SECONDS", "60")),
+                        help="Lease duration in seconds, renewed by heartbeats")
+    parser.add_argument("--poll-interval", type=float, default=float(os.getenv("WORKER_POLL_INTERVAL", "1")),
+                        help="Seconds between inbox scans")
+    parser.add_argument("--settle-seconds", type=float, default=float(os.getenv("WORKER_SETTLE_SECONDS", "2")),
+                        help="Seconds a new or modified file must be left unchanged before it is processed")
+    parser.add_argument("--once", action="store_true", help="Exit when nothing is left to claim")
+    parser.add_argument("--export", default=os.getenv("INVOICE_EXPORT_PATH", ""),
+                        help="Folder to append Parquet datasets of invoices and line items to (empty to disable)")
+    args = parser.parse_args()
+
+    job_store = JobStore(args.job_store)
+    exporter = InvoiceExporter(
+        args.export, int(os.getenv("INVOICE_EXPORT_BATCH_SIZE", "1000"))) if args.export else None
+    asyncio.run(run_worker(
+        args.input, args.output, job_store, args.worker_id, args.max_documents,
+        args.lease_seconds, args.poll_interval, once=args.once, exporter=exporter,
+        settle_seconds=args.settle_seconds))
+    for stats in job_store.worker_stats():
+        print(stats)
+    metrics.export()
+
+
+if __name__ == "__main__":
+    main()